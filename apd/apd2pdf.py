@@ -1,19 +1,116 @@
 import os
+import re
 import argparse
+import itertools
+import math
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import fpdf
+from fpdf.fpdf import SubsetMap
+from fpdf.ttfonts import TTFontFile
+from fpdf.util import escape_parens
 from . import fixed_text_file as ftf
+from . import metrics
 dir_path = os.path.dirname(os.path.realpath(__file__))
 font_dir = os.path.join(dir_path, 'fonts')
 fnormal = os.path.join(font_dir, 'DejaVuSansMono.ttf')
 fbold = os.path.join(font_dir, 'DejaVuSansMono-Bold.ttf')
+LINE_HEIGHT = 4
+# below this many report pages a process pool costs more than it saves
+PARALLEL_MIN_PAGES = 20
+FOOTER_CHARS = 'Σελίδα: από 0123456789'
+# change it when the PDF layout changes
+RENDERER_VERSION = '2'
+
+
+@lru_cache(maxsize=None)
+def font_metrics(fname):
+    """Metrics of a TTF font, parsed once per process"""
+    ttf = TTFontFile()
+    ttf.getMetrics(fname)
+    return {
+        'type': 'TTF',
+        'name': re.sub('[ ()]', '', ttf.fullName),
+        'desc': {
+            'Ascent': round(ttf.ascent),
+            'Descent': round(ttf.descent),
+            'CapHeight': round(ttf.capHeight),
+            'Flags': ttf.flags,
+            'FontBBox': (f'[{ttf.bbox[0]:.0f} {ttf.bbox[1]:.0f}'
+                         f' {ttf.bbox[2]:.0f} {ttf.bbox[3]:.0f}]'),
+            'ItalicAngle': int(ttf.italicAngle),
+            'StemV': round(ttf.stemV),
+            'MissingWidth': round(ttf.defaultWidth),
+        },
+        'up': round(ttf.underlinePosition),
+        'ut': round(ttf.underlineThickness),
+        'cw': ttf.charWidths,
+        'originalsize': os.stat(fname).st_size,
+    }
+
+
+def warm_up():
+    """Load fonts and schema into the process wide caches
+
+    Meant to run once before serving (e.g. in the gunicorn master with
+    preload, so forked workers share them).
+    """
+    font_metrics(fnormal)
+    font_metrics(fbold)
+    ftf.compiled_linetypes()
 
 
 class PDF(fpdf.FPDF):
     def __init__(self, headdata):
-        super().__init__()
+        super().__init__(font_cache_dir=None)
         self.headdata = headdata
-        self.add_font("fnormal", style="", fname=fnormal, uni=True)
-        self.add_font("fnormal", style="b", fname=fbold, uni=True)
+        self._glyph_codes = {}
+        # added to page_no() in the footer, for pages rendered in parts
+        self.page_offset = 0
+        # total pages when known in advance, else '{nb}' is substituted
+        self.page_total = None
+        # write_report() backend: write_lines, or write_cells if False
+        self.fast = True
+        self.add_cached_font("fnormal", style="", fname=fnormal)
+        self.add_cached_font("fnormal", style="b", fname=fbold)
+
+    def add_cached_font(self, family, style, fname):
+        """Same as add_font(uni=True) but with metrics from font_metrics()"""
+        font_data = font_metrics(fname)
+        fontkey = f'{family.lower()}{style.upper()}'
+        # fpdf puts these in every subset, see FPDF.add_font
+        sbarr = '\x00 '
+        if self.str_alias_nb_pages:
+            sbarr += '0123456789' + self.str_alias_nb_pages
+        self.fonts[fontkey] = {
+            'i': len(self.fonts) + 1,
+            'type': font_data['type'],
+            'name': font_data['name'],
+            'desc': font_data['desc'],
+            'up': font_data['up'],
+            'ut': font_data['ut'],
+            'cw': font_data['cw'],
+            'ttffile': fname,
+            'fontkey': fontkey,
+            'subset': SubsetMap(map(ord, sbarr)),
+            'unifilename': None,
+        }
+        self.font_files[fontkey] = {
+            'length1': font_data['originalsize'],
+            'type': 'TTF',
+            'ttffile': fname,
+        }
+        self.font_files[fname] = {'type': 'TTF'}
+
+    def reserve_glyphs(self, chars, fontkey='fnormal'):
+        """Give chars their subset codes now, in sorted order
+
+        PDFs reserving the same chars encode them identically, so their
+        page contents can be moved from one document to another.
+        """
+        pick = self.fonts[fontkey]['subset'].pick
+        for char in sorted(chars):
+            pick(ord(char))
 
     def header(self):
         self.set_font('fnormal', 'b', 12)
@@ -40,47 +137,296 @@ class PDF(fpdf.FPDF):
         self.set_y(-15)
         self.set_font('fnormal', '', 8)
         # Page number
-        self.cell(0, 10, f'Σελίδα: {self.page_no()} από ' + '{nb}', 0, 0, 'C')
+        page = self.page_no() + self.page_offset
+        total = '{nb}' if self.page_total is None else self.page_total
+        self.cell(0, 10, f'Σελίδα: {page} από {total}', 0, 0, 'C')
 
+    def goto_page(self, page):
+        """Continue writing on an earlier page (after its footer)"""
+        self.page = page
+        # forget the current font, so set_font() selects it on that page
+        self.font_family = ''
 
-def run(apd_file):
-    apd = ftf.apd_builder()
-    apd.parse(apd_file)
-    lines = apd.for_report()
-    head0 = apd.print_company_data()
-    head2 = apd.print_header()
-    # print(lines)
-    synodeytiko = apd.synodeftiko()
-    pdf = PDF(head2)
+    def lines_fitting(self, h=LINE_HEIGHT):
+        """How many lines of height h fit before the next page break"""
+        ypos = self.y
+        count = 0
+        while ypos + h <= self.page_break_trigger:
+            ypos += h
+            count += 1
+        return count
+
+    def close_page(self):
+        """Write the footer of the current page, as add_page() would"""
+        self.in_footer = 1
+        self.footer()
+        self.in_footer = 0
+
+    def page_contents(self):
+        """Close the last page and return the content of every page"""
+        self.close_page()
+        return [bytes(page['content']) for page in self.pages.values()]
+
+    def keep_pages(self, start, end):
+        """Drop every page but start..end (all of them complete)"""
+        self.close_page()
+        self.pages = {num - start + 1: self.pages[num]
+                      for num in range(start, end + 1)}
+        self.page = len(self.pages)
+        # the footers are all written
+        self.footer = lambda: None
+
+    def append_pages(self, contents):
+        """Add pages with ready contents (from page_contents()) at the end
+
+        The current page stays current, so its footer is still written
+        when the document is closed.
+        """
+        for content in contents:
+            self.pages[len(self.pages) + 1] = {
+                'content': bytearray(content),
+                'duration': 0,
+                'transition': None,
+                'w_pt': self.w_pt,
+                'h_pt': self.h_pt,
+            }
+
+    def write_report(self, lines, h=LINE_HEIGHT):
+        """Write lines with write_lines, or write_cells if not self.fast"""
+        if self.fast:
+            self.write_lines(lines, h)
+        else:
+            self.write_cells(lines, h)
+
+    def write_cells(self, lines, h=LINE_HEIGHT):
+        """Write each line with its own cell (the classic fpdf way)"""
+        for line in lines:
+            self.cell(0, h, line, 0, 1)
+
+    def write_lines(self, lines, h=LINE_HEIGHT):
+        """Write lines exactly where write_cells would put them
+
+        All the lines of a page go into a single text object (one BT/ET,
+        moving down with T*) instead of a cell() call per line, so the per
+        line cost is little more than encoding the text.
+        """
+        leading = round(h * self.k, 2)
+        block = []
+        for line in lines:
+            if self.will_page_break(h):
+                self._end_text_block(block)
+                block = []
+                self._perform_page_break()
+            # baseline of the line, rounded as cell() writes it
+            ypos = round(
+                (self.h - self.y - 0.5 * h - 0.3 * self.font_size) * self.k, 2)
+            if not block:
+                block.append(self._begin_text_block(ypos, leading))
+            elif round(previous - ypos, 2) == leading:
+                block.append('T*')
+            else:
+                block.append(f'0 {ypos - previous:.2f} Td')
+            if line:
+                block.append(f'({self._encode(line)}) Tj')
+            previous = ypos
+            self.y += h
+        self._end_text_block(block)
+        self.x = self.l_margin
+
+    def _begin_text_block(self, ypos, leading):
+        xpos = (self.l_margin + self.c_margin) * self.k
+        return (f"BT /F{self.current_font['i']} {self.font_size_pt:.2f} Tf "
+                f'{xpos:.2f} {ypos:.2f} Td {leading:.2f} TL')
+
+    def _end_text_block(self, block):
+        if block:
+            block.append('ET')
+            self._out(' '.join(block))
+
+    def _encode(self, text):
+        """Text as a PDF string of the current font's subset codes"""
+        if not self.unifontsubset:
+            return escape_parens(text)
+        codes = self._glyph_codes.setdefault(self.current_font['i'], {})
+        try:
+            return ''.join([codes[char] for char in text])
+        except KeyError:
+            pick = self.current_font['subset'].pick
+            for char in set(text).difference(codes):
+                mapped = chr(pick(ord(char)))
+                codes[char] = escape_parens(
+                    mapped.encode('UTF-16BE').decode('latin-1'))
+            return ''.join([codes[char] for char in text])
+
+
+def report_lines(blocks):
+    """The lines of the report blocks, signatures included"""
+    for block in blocks:
+        for col in block:
+            yield col.rstrip()
+    yield ''
+    yield ''
+    yield '       Ο ΔΗΛΩΝ ΕΡΓΟΔΟΤΗΣ                                          Ο ΠΑΡΑΛΑΒΩΝ'
+
+
+def report_page_lines(headdata):
+    """How many report lines fill a page after the heada1 header"""
+    probe = PDF(headdata)
+    probe.header = probe.heada1
+    probe.set_font('fnormal', '', 10)
+    probe.add_page()
+    return probe.lines_fitting()
+
+
+def render_pages(headdata, charset, lines, page_offset, fast=True):
+    """Page contents of lines laid out from the top of a report page
+
+    Runs in the worker processes of build(jobs=...); page_offset is the
+    number of pages before the first one.
+    """
+    pdf = PDF(headdata)
+    pdf.reserve_glyphs(charset)
+    pdf.page_offset = page_offset
+    pdf.header = pdf.heada1
+    pdf.set_font('fnormal', '', 10)
+    pdf.fast = fast
+    pdf.add_page()
+    pdf.write_report(lines)
+    return pdf.page_contents()
+
+
+def start_report(apd, fast=True, charset=(), page_total=None):
+    """PDF with an empty cover page and the start of the report
+
+    The cover page is written last, by finish_report(), as its totals are
+    only known once the whole file is read.
+    """
+    pdf = PDF(apd.print_header())
+    pdf.reserve_glyphs(charset)
+    pdf.page_total = page_total
     pdf.alias_nb_pages()
     pdf.add_page()
+    pdf.cover_y = pdf.y
     pdf.set_font('fnormal', '', 10)
-    for lns in synodeytiko.split('\n'):
-        pdf.cell(0, 4, f'{lns.rstrip()}', 0, 1)
     pdf.header = pdf.heada0
     pdf.add_page()
-    for lns in head0.split('\n'):
-        pdf.header = pdf.heada1
-        pdf.cell(0, 4, f'{lns.rstrip()}', 0, 1)
-    for lin in lines:
-        for col in lin:
-            pdf.cell(0, 4, f'{col.rstrip()}', 0, 1)
-        # pdf.add_page()
-    pdf.cell(0, 4, '', 0, 1)
-    pdf.cell(0, 4, '', 0, 1)
-    final = '       Ο ΔΗΛΩΝ ΕΡΓΟΔΟΤΗΣ                                          Ο ΠΑΡΑΛΑΒΩΝ'
-    pdf.cell(0, 4, final, 0, 1)
+    pdf.header = pdf.heada1
+    pdf.fast = fast
+    pdf.write_report(
+        lns.rstrip() for lns in apd.print_company_data().split('\n'))
+    return pdf
+
+
+def finish_report(pdf, apd):
+    """Write the cover page of a report made by start_report()"""
+    last = pdf.page
+    pdf.goto_page(1)
+    pdf.y = pdf.cover_y
+    pdf.set_font('fnormal', '', 10)
+    pdf.write_report(lns.rstrip() for lns in apd.synodeftiko().split('\n'))
+    pdf.goto_page(last)
+    return pdf
+
+
+def build(apd_file, fast=True, jobs=1):
+    """Parse apd_file and lay out its report, returning the PDF
+
+    With jobs=1 the report lines are written as the file is parsed,
+    without keeping the employee and payroll lines in memory.
+    """
+    apd = ftf.apd_builder(shared=True)
+    if jobs > 1:
+        with metrics.stage('parse'):
+            apd.parse(apd_file)
+        return build_document(apd, fast, jobs)
+    # parsing and formatting are interleaved with the layout here
+    blocks = metrics.timed(apd.iter_report(apd_file), 'parse')
+    with metrics.stage('layout', exclude=blocks):
+        # reading the first block reads the header line too
+        first = next(blocks, None)
+        pdf = start_report(apd, fast)
+        if first is not None:
+            blocks = itertools.chain([first], blocks)
+        pdf.write_report(report_lines(blocks))
+        pdf = finish_report(pdf, apd)
+    record_document(apd, pdf)
+    return pdf
+
+
+def record_document(apd, pdf):
+    """Record the record and page counts of a converted document"""
+    metrics.observe('apd_records', apd.total_ergnoi, kind='employee')
+    metrics.observe('apd_records', apd.totals.count, kind='payroll')
+    metrics.observe('apd_pdf_pages', pdf.page)
+
+
+def build_document(apd, fast=True, jobs=1):
+    """Lay out the report of a parsed Document, returning the PDF
+
+    fast=False writes every line with its own cell() call.
+    jobs > 1 renders the report pages in that many processes, in page
+    aligned chunks whose contents are appended to the returned PDF.
+    """
+    with metrics.stage('report'):
+        lines = list(report_lines(apd.for_report()))
+    with metrics.stage('layout'):
+        pdf = _lay_out(apd, lines, fast, jobs)
+    record_document(apd, pdf)
+    return pdf
+
+
+def _lay_out(apd, lines, fast, jobs):
+    head2 = apd.print_header()
+    charset = set(head2).union(FOOTER_CHARS, *lines)
+    pdf = start_report(apd, fast, charset)
+    if jobs > 1:
+        first = pdf.lines_fitting()
+        pdf.write_report(lines[:first])
+        lines = lines[first:]
+        per_page = report_page_lines(head2)
+        pages = math.ceil(len(lines) / per_page)
+        if pages and pages >= PARALLEL_MIN_PAGES:
+            size = math.ceil(pages / jobs) * per_page
+            chunks = [lines[i:i + size] for i in range(0, len(lines), size)]
+            offsets = [pdf.page + i * size // per_page
+                       for i in range(len(chunks))]
+            with ProcessPoolExecutor(jobs) as pool:
+                for contents in pool.map(
+                        render_pages, [head2] * len(chunks),
+                        [charset] * len(chunks), chunks, offsets,
+                        [fast] * len(chunks)):
+                    pdf.append_pages(contents)
+            return finish_report(pdf, apd)
+    pdf.write_report(lines)
+    return finish_report(pdf, apd)
+
+
+def run(apd_file, fast=True, jobs=1):
+    """Write the PDF of apd_file next to it, returning the PDF file name
+
+    apd_file may also be the content (bytes) or an open file; the PDF is
+    returned as bytes then, nothing is written to disk.
+    """
+    pdf = build(apd_file, fast, jobs)
+    if not isinstance(apd_file, str):
+        with metrics.stage('output'):
+            return bytes(pdf.output())
     out_filename = f'{apd_file}.pdf'
-    pdf.output(out_filename, 'F')
+    with metrics.stage('output'):
+        pdf.output(out_filename, 'F')
     return out_filename
 
 
 if __name__ == '__main__':
     prs = argparse.ArgumentParser(description='APD to PDF')
     prs.add_argument('apdfile', help='APD file')
+    prs.add_argument('-j', '--jobs', type=int, default=1,
+                     help='render the report pages in JOBS processes')
+    prs.add_argument('--cells', action='store_true',
+                     help='write one cell per line (slow classic layout)')
     prs.add_argument('--version', action='version', version='0.1')
     arg = prs.parse_args()
     if not os.path.isfile(arg.apdfile):
         print('File %s does not exist' % arg.apdfile)
     else:
-        run(arg.apdfile)
+        run(arg.apdfile, not arg.cells, arg.jobs)
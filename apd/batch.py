@@ -0,0 +1,129 @@
+"""Convert many APD files to PDF in one run
+
+Files are given as directories (searched recursively for PATTERN),
+glob patterns or a manifest (a text file with one path per line, '#'
+starts a comment). They are converted in a pool of worker processes, so
+fonts and schema are loaded once per worker instead of once per file.
+A PDF newer than its APD file is left alone unless --force is given.
+
+The summary is a JSON object with one entry per file:
+
+    {"file": ..., "output": ..., "status": "ok" | "skipped" | "error",
+     "seconds": ..., "errors_found": [...], "error": ...}
+
+python -m apd.batch -j 8 --summary summary.json clients/ 'extra/*.zip'
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from . import apd2pdf
+from . import fixed_text_file as ftf
+
+PATTERN = 'CSL01*'
+
+
+def output_name(apd_file):
+    return f'{apd_file}.pdf'
+
+
+def expand(paths, manifest=None, pattern=PATTERN):
+    """APD files of paths (files, directories or globs) and manifest"""
+    paths = list(paths)
+    if manifest:
+        with open(manifest, encoding='utf-8') as fil:
+            for lin in fil:
+                lin = lin.split('#', 1)[0].strip()
+                if lin:
+                    paths.append(lin)
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = glob.glob(
+                os.path.join(path, '**', pattern), recursive=True)
+        elif os.path.exists(path):
+            found = [path]
+        else:
+            found = glob.glob(path, recursive=True)
+        files += sorted(i for i in found
+                        if os.path.isfile(i) and not i.endswith('.pdf'))
+    return list(dict.fromkeys(files))
+
+
+def is_up_to_date(apd_file):
+    out = output_name(apd_file)
+    return (os.path.exists(out)
+            and os.path.getmtime(out) >= os.path.getmtime(apd_file))
+
+
+def convert(apd_file, force=False, fast=True):
+    """Convert one file, returning its summary entry"""
+    result = {'file': apd_file, 'output': output_name(apd_file),
+              'status': 'ok', 'seconds': 0.0, 'errors_found': None,
+              'error': None}
+    start = time.perf_counter()
+    if not force and is_up_to_date(apd_file):
+        result['status'] = 'skipped'
+        return result
+    try:
+        apd = ftf.apd_builder(shared=True)
+        apd.parse(apd_file)
+        result['errors_found'] = apd.errors_found()
+        pdf = apd2pdf.build_document(apd, fast)
+        pdf.output(result['output'], 'F')
+    except Exception as err:  # one bad file must not stop the batch
+        result['status'] = 'error'
+        result['error'] = f'{type(err).__name__}: {err}'
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def run(files, jobs=1, force=False, fast=True):
+    """Convert files using jobs processes, returning the summary"""
+    start = time.perf_counter()
+    if jobs > 1 and len(files) > 1:
+        with ProcessPoolExecutor(jobs, initializer=apd2pdf.warm_up) as pool:
+            results = list(pool.map(
+                convert, files, [force] * len(files), [fast] * len(files),
+                chunksize=max(1, len(files) // (jobs * 4))))
+    else:
+        results = [convert(fil, force, fast) for fil in files]
+    summary = {status: sum(1 for i in results if i['status'] == status)
+               for status in ('ok', 'skipped', 'error')}
+    summary['seconds'] = round(time.perf_counter() - start, 3)
+    summary['files'] = results
+    return summary
+
+
+def main(argv=None):
+    prs = argparse.ArgumentParser(description='APD files to PDF (batch)')
+    prs.add_argument('paths', nargs='*',
+                     help='APD files, directories or glob patterns')
+    prs.add_argument('-m', '--manifest', help='file with one path per line')
+    prs.add_argument('-p', '--pattern', default=PATTERN,
+                     help=f'file pattern in directories ({PATTERN})')
+    prs.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                     help='worker processes (all cpus)')
+    prs.add_argument('-f', '--force', action='store_true',
+                     help='convert files with an up to date PDF too')
+    prs.add_argument('-s', '--summary', help='write the summary here '
+                     '(default: standard output)')
+    prs.add_argument('--cells', action='store_true',
+                     help='write one cell per line (slow classic layout)')
+    arg = prs.parse_args(argv)
+    files = expand(arg.paths, arg.manifest, arg.pattern)
+    summary = run(files, arg.jobs, arg.force, not arg.cells)
+    if arg.summary:
+        with open(arg.summary, 'w', encoding='utf-8') as fil:
+            json.dump(summary, fil, ensure_ascii=False, indent=1)
+    else:
+        json.dump(summary, sys.stdout, ensure_ascii=False, indent=1)
+        print()
+    return 1 if summary['error'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""Vectorized (NumPy) engine for the payroll ('3') lines of an APD
+
+All '3' lines are gathered into one byte buffer, which is viewed as a
+NumPy structured array of S<size> fields built from the schema columns.
+Numeric columns (ColPoso, ColInt, ColIntSpace) are converted to int64 in
+bulk (amounts as integer cents), so totals and validation are array
+reductions instead of per record Python work.
+
+numpy is an optional dependency, needed only by this module.
+
+python -m apd.bulk times Document.scan against load on sample_mix().
+"""
+import os
+import time
+from . import fixed_text_file as ftf
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+NUMERIC_TYPES = (ftf.ColPoso, ftf.ColInt, ftf.ColIntSpace)
+TYPE_18 = (b'018', b'019')
+
+
+def payroll_dtype(linetype):
+    """Structured dtype with one S<size> field per column of linetype"""
+    fields = [('line_code', f'S{len(linetype.prefix)}')]
+    fields += [(col.name, f'S{col.size}') for col in linetype.columns]
+    return np.dtype(fields)
+
+
+class PayrollTable:
+    """Payroll lines of a document decoded with NumPy
+
+    :param document: schema Document (from apd_builder); its header,
+        employee count and money mode are filled by load()
+    """
+
+    def __init__(self, document, buffer: bytes, count: int):
+        if np is None:
+            raise ImportError('PayrollTable requires numpy')
+        self.document = document
+        self.linetype = document.linetypes['3']
+        self.count = count
+        self.records = np.frombuffer(
+            buffer, dtype=payroll_dtype(self.linetype), count=count)
+        self.digits = np.frombuffer(buffer, dtype=np.uint8).reshape(
+            count, self.linetype.size)
+        self._columns = {}
+
+    @property
+    def header(self):
+        return self.document.lines[0]
+
+    def column(self, name: str):
+        """int64 values of a numeric column (integer cents for amounts)
+
+        Raises ValueError for a field that is not digits (padded with
+        spaces at most), like the row parser does.
+        """
+        if name not in self._columns:
+            col = self.linetype.colbyname[name]
+            if not isinstance(col.column_type, NUMERIC_TYPES):
+                raise ValueError(f'Column {name!r} is not numeric')
+            _, apo, eos, _ = self.linetype.slices[
+                self.linetype.columns.index(col)]
+            raw = self.digits[:, apo:eos]
+            digits = raw.astype(np.int64) - ord('0')
+            # spaces may only pad the ends, as int() of the row parser
+            # allows, and a field may not be blank
+            space = raw == ord(' ')
+            front = np.logical_and.accumulate(space, axis=1)
+            back = np.logical_and.accumulate(space[:, ::-1], axis=1)[:, ::-1]
+            padding = front | back
+            bad = ((digits < 0) | (digits > 9)) & ~padding
+            bad[:, -1] |= front[:, -1]
+            if bad.any():
+                row = int(np.flatnonzero(bad.any(axis=1))[0])
+                raise ValueError(
+                    f'payroll line {row + 1}: {name} '
+                    f'({raw[row].tobytes()!r}) is not a number in '
+                    f'textline({self.digits[row].tobytes()!r})')
+            digits[padding] = 0
+            weights = 10 ** np.arange(eos - apo - 1, -1, -1, dtype=np.int64)
+            # trailing spaces shift the digits left, undo it
+            self._columns[name] = (digits @ weights) // 10 ** back.sum(axis=1)
+        return self._columns[name]
+
+    def _money(self, cents):
+        cents = int(cents)
+        return cents if self.document.cents else round(cents / 100, 2)
+
+    def _sums(self, mask=None):
+        meres = self.column('imeres_asfalisis')
+        apodoxes = self.column('apodoxes')
+        eisfores = self.column('katablitees_eisfores')
+        if mask is not None:
+            meres = meres[mask]
+            apodoxes = apodoxes[mask]
+            eisfores = eisfores[mask]
+        return [int(meres.sum()), self._money(apodoxes.sum()),
+                self._money(eisfores.sum())]
+
+    def get_totals(self):
+        meres, apodoxes, eisfores = self._sums()
+        return apodoxes, eisfores, meres
+
+    def totals_by_18(self):
+        is18 = np.isin(self.records['apodoxes_type'], TYPE_18)
+        return {'18': self._sums(is18), 'no': self._sums(~is18)}
+
+    def errors_found(self):
+        return ftf.header_errors(self.header, self.get_totals())
+
+
+def raw_lines(source) -> list:
+    """All the undecoded lines of source, split at C speed when possible"""
+    if isinstance(source, str) and not source.endswith('.zip'):
+        with open(source, 'rb') as fil:
+            return fil.read().splitlines()
+    if isinstance(source, (bytes, bytearray)) and \
+            bytes(source[:len(ftf.ZIP_MAGIC)]) != ftf.ZIP_MAGIC:
+        return source.splitlines()
+    return list(ftf.iter_raw_lines(source))
+
+
+def load(source, document=None) -> PayrollTable:
+    """Parse source, decoding the payroll lines in bulk
+
+    Only the header and terminator lines are parsed and added to
+    document; employee ('2') lines are counted (total_ergnoi) but, as by
+    Document.scan, not stored, and '3' lines only go into the
+    PayrollTable buffer.
+    """
+    if document is None:
+        document = ftf.apd_builder()
+    linetype = document.linetypes['3']
+    prefix = linetype.prefix.encode(ftf.ENCODING)
+    employee = document.linetypes['2']
+    employee_prefix = employee.prefix.encode(ftf.ENCODING)
+    lines = raw_lines(source)
+    chunks = [lin for lin in lines if lin.startswith(prefix)]
+    buffer = b''.join(chunks)
+    if len(buffer) != len(chunks) * linetype.size:
+        lin = next(lin for lin in chunks if len(lin) != linetype.size)
+        raise ValueError(f'textline({lin}) size ({len(lin)}) is not correct')
+    for lin in lines:
+        if lin.startswith(prefix):
+            continue
+        if lin.startswith(employee_prefix):
+            if len(lin) != employee.size:
+                raise ValueError(
+                    f'textline({lin}) size ({len(lin)}) is not correct')
+            document.total_ergnoi += 1
+            continue
+        other = document.linetype_for(lin)
+        if other is None:
+            continue
+        document.add_line(other.read_bytes(lin, keep_raw=document.keep_raw))
+    return PayrollTable(document, buffer, len(chunks))
+
+
+def sample_mix(employees=96_000, sample=None) -> bytes:
+    """An APD with the employee / payroll mix of a real declaration
+
+    The employee and payroll lines of sample (the test CSL01), every
+    third employee with two payroll lines: 96k employees, 128k payroll.
+    """
+    sample = sample or os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), 'tests', 'CSL01')
+    with open(sample, 'rb') as fil:
+        lines = fil.read().splitlines()
+    workers = [lin for lin in lines if lin.startswith(b'2')]
+    payroll = [lin for lin in lines if lin.startswith(b'3')]
+    out = [lines[0]]
+    for i in range(employees):
+        out.append(workers[i % len(workers)])
+        out.append(payroll[i % len(payroll)])
+        if i % 3 == 0:
+            out.append(payroll[(i + 1) % len(payroll)])
+    out.append(lines[-1])
+    return b'\r\n'.join(out) + b'\r\n'
+
+
+def bench(data, runs=3) -> dict:
+    """Best seconds of Document.scan and of load + totals over data"""
+
+    def scan():
+        ftf.apd_builder(shared=True).scan(data)
+
+    def bulk():
+        load(data, ftf.apd_builder(shared=True)).totals_by_18()
+
+    best = {}
+    for name, func in (('scan', scan), ('bulk', bulk)):
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        best[name] = min(times)
+    return best
+
+
+if __name__ == '__main__':
+    for name, seconds in bench(sample_mix()).items():
+        print(f'{name:5} {seconds:.3f} s')
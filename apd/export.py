@@ -0,0 +1,274 @@
+"""Export the payroll lines of an APD as CSV, JSON Lines or columns
+
+Every exporter writes one row per payroll ('3') record, joined with the
+fields of its employee ('2') record, with the columns of the schema as
+fields. Files are read and written incrementally: no exporter keeps the
+document in memory.
+
+Amounts are parsed as integer cents. CSV and JSON Lines write them in
+euros (exactly, from the cents) unless cents=True.
+
+The columnar file holds each column as one contiguous block: amounts
+and integers as int64, everything else as the fixed width WINDOWS-1253
+bytes of the field. ColumnFile maps it back without reading it:
+
+    APDCOLS1 | header size (uint64) | JSON header | column blocks
+
+The header lists rows, byteorder and, per column, name, label, typecode
+('q' or 's'), size and offset. Blocks start at 8 byte boundaries.
+"""
+import os
+import io
+import sys
+import csv
+import json
+import mmap
+import shutil
+import argparse
+import tempfile
+from array import array
+from . import fixed_text_file as ftf
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+MAGIC = b'APDCOLS1'
+# rows kept in memory per column before they are spilled to disk
+SPILL_ROWS = 1 << 14
+
+
+def export_columns(document):
+    """(linetype, Col) of the exported fields: employee, then payroll"""
+    return [(document.linetypes[code], col)
+            for code in ('2', '3') for col in document.linetypes[code].columns]
+
+
+def iter_rows(document, source, lazy=False):
+    """(employee, payroll) record pairs of source, employee may be None"""
+    for linetype, record, employee in document.iter_records(source, lazy):
+        if linetype.prefix == '3':
+            yield employee, record
+
+
+def _row_values(columns, employee, payroll, cents):
+    values = []
+    for linetype, col in columns:
+        record = payroll if linetype.prefix == '3' else employee
+        if record is None:
+            values.append(None)
+            continue
+        value = record[col.name]
+        if not cents and isinstance(col.column_type, ftf.ColPosoCents):
+            value = f'{value / 100:.2f}'
+        values.append(value)
+    return values
+
+
+def write_csv(source, stream, cents=False, labels=False):
+    """Write the rows of source to a text stream, returning their count
+
+    labels=True uses the Greek column labels for the header row.
+    """
+    document = ftf.apd_builder(cents=True, shared=True)
+    columns = export_columns(document)
+    writer = csv.writer(stream)
+    writer.writerow([col.lbl if labels else col.name for _, col in columns])
+    count = 0
+    for employee, payroll in iter_rows(document, source):
+        writer.writerow(_row_values(columns, employee, payroll, cents))
+        count += 1
+    return count
+
+
+def write_jsonl(source, stream, cents=False):
+    """Write the rows of source as JSON objects, one per line"""
+    document = ftf.apd_builder(cents=True, shared=True)
+    columns = export_columns(document)
+    names = [col.name for _, col in columns]
+    count = 0
+    for employee, payroll in iter_rows(document, source):
+        values = _row_values(columns, employee, payroll, cents)
+        if not cents:
+            values = [float(val) if isinstance(col.column_type,
+                                               ftf.ColPosoCents) else val
+                      for (_, col), val in zip(columns, values)]
+        stream.write(json.dumps(dict(zip(names, values)), ensure_ascii=False))
+        stream.write('\n')
+        count += 1
+    return count
+
+
+class _Spill:
+    """A column being written: rows are buffered, then spilled to disk"""
+
+    def __init__(self, linetype, col):
+        self.col = col
+        self.payroll = linetype.prefix == '3'
+        self.typecode = 'q' if col.column_type.typecode else 's'
+        _, self.apo, self.eos, _ = linetype.slices[
+            linetype.columns.index(col)]
+        self.size = 8 if self.typecode == 'q' else col.size
+        self.file = tempfile.TemporaryFile()
+        self._clear()
+
+    def _clear(self):
+        self.buffer = array('q') if self.typecode == 'q' else bytearray()
+
+    def append(self, record):
+        if self.typecode == 'q':
+            self.buffer.append(
+                0 if record is None else record[self.col.name])
+        elif record is None:
+            self.buffer += b' ' * self.size
+        else:
+            self.buffer += record.raw[self.apo:self.eos]
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self._clear()
+
+
+def write_columns(source, filename):
+    """Write the rows of source to a columnar file, returning their count"""
+    document = ftf.apd_builder(cents=True, shared=True)
+    spills = [_Spill(linetype, col)
+              for linetype, col in export_columns(document)]
+    count = 0
+    try:
+        for employee, payroll in iter_rows(document, source, lazy=True):
+            for spill in spills:
+                spill.append(payroll if spill.payroll else employee)
+            count += 1
+            if count % SPILL_ROWS == 0:
+                for spill in spills:
+                    spill.flush()
+        columns = []
+        offset = 0
+        for spill in spills:
+            spill.flush()
+            columns.append({'name': spill.col.name, 'label': spill.col.lbl,
+                            'typecode': spill.typecode, 'size': spill.size,
+                            'offset': offset})
+            offset += _aligned(spill.size * count)
+        header = json.dumps({'rows': count, 'byteorder': sys.byteorder,
+                             'encoding': ftf.ENCODING, 'columns': columns},
+                            ensure_ascii=False).encode('utf-8')
+        start = _aligned(len(MAGIC) + 8 + len(header))
+        with open(filename, 'wb') as fil:
+            fil.write(MAGIC)
+            fil.write(len(header).to_bytes(8, 'little'))
+            fil.write(header.ljust(start - len(MAGIC) - 8))
+            for spill, column in zip(spills, columns):
+                fil.seek(start + column['offset'])
+                spill.file.seek(0)
+                shutil.copyfileobj(spill.file, fil)
+            fil.truncate(start + offset)
+    finally:
+        for spill in spills:
+            spill.file.close()
+    return count
+
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
+
+
+class TextColumn:
+    """The stripped strings of a text column, decoded on access"""
+
+    def __init__(self, view, size):
+        self.view = view
+        self.size = size
+
+    def __len__(self):
+        return len(self.view) // self.size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        raw = self.view[index * self.size:(index + 1) * self.size]
+        return ftf.decode(bytes(raw)).strip()
+
+
+class ColumnFile:
+    """A file written by write_columns, memory mapped"""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fil:
+            self._map = mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{filename} is not an APD columnar file')
+        size = int.from_bytes(self._map[len(MAGIC):len(MAGIC) + 8], 'little')
+        start = len(MAGIC) + 8
+        header = json.loads(self._map[start:start + size].decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError(f"{filename} is {header['byteorder']} endian")
+        self.rows = header['rows']
+        self.start = _aligned(start + size)
+        self.columns = {col['name']: col for col in header['columns']}
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def names(self):
+        return list(self.columns)
+
+    def _view(self, col):
+        apo = self.start + col['offset']
+        return memoryview(self._map)[apo:apo + col['size'] * self.rows]
+
+    def column(self, name):
+        """int64 values (memoryview) or a TextColumn, without copying"""
+        col = self.columns[name]
+        if col['typecode'] == 'q':
+            return self._view(col).cast('q')
+        return TextColumn(self._view(col), col['size'])
+
+    def array(self, name):
+        """The column as a NumPy array (int64 or S<size>) over the map"""
+        if np is None:
+            raise ImportError('ColumnFile.array requires numpy')
+        col = self.columns[name]
+        dtype = np.int64 if col['typecode'] == 'q' else f"S{col['size']}"
+        return np.frombuffer(self._map, dtype=dtype, count=self.rows,
+                             offset=self.start + col['offset'])
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl}
+
+
+def export(source, filename, fmt=None, cents=False):
+    """Export source to filename, the format given or from its extension"""
+    fmt = fmt or os.path.splitext(filename)[1].lstrip('.')
+    if fmt == 'col':
+        return write_columns(source, filename)
+    if fmt not in WRITERS:
+        raise ValueError(f'Unknown export format {fmt!r}')
+    with io.open(filename, 'w', encoding='utf-8', newline='') as fil:
+        return WRITERS[fmt](source, fil, cents)
+
+
+if __name__ == '__main__':
+    prs = argparse.ArgumentParser(description='APD payroll lines export')
+    prs.add_argument('apdfile', help='APD file')
+    prs.add_argument('outfile', help='output file (.csv, .jsonl or .col)')
+    prs.add_argument('-f', '--format', choices=['csv', 'jsonl', 'col'],
+                     help='output format (default: from the extension)')
+    prs.add_argument('--cents', action='store_true',
+                     help='amounts as integer cents (csv, jsonl)')
+    arg = prs.parse_args()
+    print(export(arg.apdfile, arg.outfile, arg.format, arg.cents), 'rows')
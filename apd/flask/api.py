@@ -0,0 +1,81 @@
+"""JSON checks of an APD upload, without rendering a PDF
+
+POST the file as the 'file' field of a form or as the request body:
+
+/api/validate  {"valid", "errors_found", "employees"}
+/api/totals    {"totals": {"meres", "apodoxes", "eisfores"},
+                "totals_by_18": {"18": {...}, "no": {...}},
+                "employees", "errors_found"}
+
+Amounts are in euros, summed exactly as integer cents. The upload is
+only scanned (Document.scan): nothing but the header is stored and only
+the columns of the totals are decoded. This module does not import fpdf
+or load fonts.
+
+Latency budgets, median per request (BUDGETS, checked by
+python -m apd.flask.bench):
+
+    uploads up to    8 KB      5 ms
+    uploads up to    1 MB    100 ms
+    uploads up to   16 MB   1500 ms
+"""
+import zipfile
+from flask import Blueprint, request, jsonify
+from apd import fixed_text_file as ftf
+from apd import metrics
+
+# upload size (bytes) -> median milliseconds allowed
+BUDGETS = {
+    8 * 1024: 5,
+    1024 * 1024: 100,
+    16 * 1024 * 1024: 1500,
+}
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+
+def scanned_upload():
+    """Document of the uploaded file or request body, scanned"""
+    upload = request.files.get('file')
+    source = upload.stream if upload is not None else request.get_data()
+    apd = ftf.apd_builder(cents=True, shared=True)
+    with metrics.stage('scan'):
+        apd.scan(source)
+    apd.check_header()
+    return apd
+
+
+def euros(cents):
+    return cents / 100
+
+
+def money_totals(meres, apodoxes, eisfores):
+    return {'meres': meres, 'apodoxes': euros(apodoxes),
+            'eisfores': euros(eisfores)}
+
+
+@api.errorhandler(ValueError)
+@api.errorhandler(KeyError)
+@api.errorhandler(zipfile.BadZipFile)
+def bad_upload(err):
+    return jsonify(error=f'{type(err).__name__}: {err}'), 400
+
+
+@api.route('/validate', methods=['POST'])
+def validate():
+    apd = scanned_upload()
+    errors = apd.errors_found()
+    return jsonify(valid=not errors, errors_found=errors,
+                   employees=apd.total_ergnoi)
+
+
+@api.route('/totals', methods=['POST'])
+def totals():
+    apd = scanned_upload()
+    apodoxes, eisfores, meres = apd.get_totals()
+    return jsonify(
+        totals=money_totals(meres, apodoxes, eisfores),
+        totals_by_18={key: money_totals(*val)
+                      for key, val in apd.totals_by_18().items()},
+        employees=apd.total_ergnoi,
+        errors_found=apd.errors_found())
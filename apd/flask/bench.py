@@ -0,0 +1,88 @@
+"""Latency of the /api endpoints against their budgets
+
+python -m apd.flask.bench [-n RUNS] [APD files]
+
+Without files the uploads are made of the test CSL01 repeated up to the
+sizes of api.BUDGETS. Times are of the full request through the Flask
+test client (parsing the multipart body included, network excluded).
+Exits with 1 if any median is over its budget.
+"""
+import io
+import os
+import sys
+import time
+import argparse
+import statistics
+from flask import Flask
+from apd.flask.api import api, BUDGETS
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+SAMPLE = os.path.join(dir_path, '..', 'tests', 'CSL01')
+
+
+def sample_upload(size, sample=SAMPLE):
+    """An APD of about size bytes: the sample's records repeated"""
+    with open(sample, 'rb') as fil:
+        lines = fil.read().splitlines(keepends=True)
+    header, body, tail = lines[0], lines[1:-1], lines[-1]
+    block = b''.join(body)
+    count = max(1, (size - len(header) - len(tail)) // len(block))
+    return header + block * count + tail
+
+
+def budget_of(size):
+    """Budget (ms) of the smallest BUDGETS size not below size"""
+    for limit in sorted(BUDGETS):
+        if size <= limit:
+            return BUDGETS[limit]
+    return None
+
+
+def time_endpoint(client, url, data, runs):
+    """Milliseconds of runs POSTs of data to url, sorted"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        resp = client.post(url, data={'file': (io.BytesIO(data), 'CSL01')})
+        times.append((time.perf_counter() - start) * 1000)
+        if resp.status_code != 200:
+            raise ValueError(f'{url}: {resp.status_code} {resp.data!r}')
+    return sorted(times)
+
+
+def run(uploads, runs=20):
+    """Print median / p95 per endpoint and upload, True if within budget"""
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    client = app.test_client()
+    within = True
+    for name, data in uploads:
+        budget = budget_of(len(data))
+        for url in ('/api/validate', '/api/totals'):
+            time_endpoint(client, url, data, 1)  # warm up
+            times = time_endpoint(client, url, data, runs)
+            median = statistics.median(times)
+            p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+            ok = budget is None or median <= budget
+            within = within and ok
+            print(f'{name:>24} {len(data) // 1024:>7} KB {url:<14} '
+                  f'median {median:8.2f} ms  p95 {p95:8.2f} ms  '
+                  f'budget {budget} ms {"ok" if ok else "OVER"}')
+    return within
+
+
+if __name__ == '__main__':
+    prs = argparse.ArgumentParser(description='/api latency benchmark')
+    prs.add_argument('files', nargs='*', help='APD files to upload')
+    prs.add_argument('-n', '--runs', type=int, default=20,
+                     help='requests per endpoint and upload')
+    arg = prs.parse_args()
+    if arg.files:
+        uploads = []
+        for name in arg.files:
+            with open(name, 'rb') as fil:
+                uploads.append((os.path.basename(name), fil.read()))
+    else:
+        uploads = [(f'CSL01 x {size // 1024} KB', sample_upload(size))
+                   for size in sorted(BUDGETS)]
+    sys.exit(0 if run(uploads, arg.runs) else 1)
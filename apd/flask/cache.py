@@ -0,0 +1,154 @@
+"""Generated PDFs stored by the hash of their upload
+
+The key is the SHA-256 of the schema, renderer and fpdf versions plus
+the uploaded bytes, so a repeat upload finds its PDF without parsing,
+and a new release never serves PDFs of an older layout. Entries are
+<key>.pdf files; reading one touches it, and adding one evicts the
+least recently used entries beyond max_bytes / max_entries.
+
+Each process keeps a running size and entry count of the directory,
+counted once and then updated by its own additions, so adding an entry
+does not list the directory. The other processes' additions are only
+seen when the directory is listed again: to evict, or rescan seconds
+after the last listing.
+"""
+import os
+import re
+import time
+import shutil
+import threading
+import hashlib
+import fpdf
+from apd import apd2pdf
+from apd import fixed_text_file as ftf
+
+VERSION = f'{ftf.SCHEMA_VERSION}/{apd2pdf.RENDERER_VERSION}/{fpdf.FPDF_VERSION}'
+KEY = re.compile(r'^[0-9a-f]{64}$')
+
+
+def new_hash():
+    """sha256 to feed the upload bytes to, for ResultCache keys"""
+    return hashlib.sha256(f'{VERSION}\n'.encode('utf-8'))
+
+
+class ResultCache:
+    """LRU cache of PDF files in directory"""
+
+    def __init__(self, directory, max_bytes=1 << 30, max_entries=1000,
+                 rescan=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.rescan = rescan
+        os.makedirs(directory, exist_ok=True)
+        # running size and count of the entries, as of the last listing
+        # plus this process's additions; None until first counted
+        self._bytes = None
+        self._count = None
+        self._scanned = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the running totals stay in the process that counted them
+        state = dict(self.__dict__)
+        state.update(_bytes=None, _count=None, _scanned=0)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        if not KEY.match(key or ''):
+            return None
+        return os.path.join(self.directory, f'{key}.pdf')
+
+    def get(self, key):
+        """Path of the PDF of key (marked as recently used), else None"""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except (OSError, TypeError):
+            return None
+        return path
+
+    def put(self, key, filename):
+        """Move filename into the cache as the PDF of key"""
+        path = self.path(key)
+        replaced = self._size(path)
+        try:
+            os.replace(filename, path)
+        except OSError:  # another filesystem
+            shutil.copyfile(filename, f'{path}.{os.getpid()}')
+            os.replace(f'{path}.{os.getpid()}', path)
+            os.remove(filename)
+        self._added(path, replaced)
+        return path
+
+    def store(self, key, data):
+        """Write data (the PDF bytes) into the cache as the PDF of key"""
+        path = self.path(key)
+        replaced = self._size(path)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp, 'wb') as fil:
+            fil.write(data)
+        os.replace(tmp, path)
+        self._added(path, replaced)
+        return path
+
+    @staticmethod
+    def _size(path):
+        """Size of the entry at path, None if there is none"""
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return None
+
+    def _added(self, path, replaced):
+        """Count the new entry at path, evicting when over the limits"""
+        size = self._size(path) or 0
+        with self._lock:
+            if self._count is not None and \
+                    time.monotonic() - self._scanned < self.rescan:
+                if replaced is None:
+                    self._count += 1
+                    self._bytes += size
+                else:
+                    self._bytes += size - replaced
+                if self._count <= self.max_entries and \
+                        self._bytes <= self.max_bytes:
+                    return
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """Delete the least recently used PDFs beyond the limits
+
+        Lists the directory, and so recounts the running totals.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pdf') and entry.path != keep:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        if keep is not None:
+            total += os.path.getsize(keep)
+            count += 1
+        for _, size, path in entries:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            count -= 1
+            total -= size
+        with self._lock:
+            self._bytes, self._count = total, count
+            self._scanned = time.monotonic()
@@ -0,0 +1,356 @@
+"""Background PDF conversions, kept on the filesystem
+
+Every job is a directory under the queue directory, named by the job id,
+with the upload (input), job.json (its state) and, once done, the PDF
+(output.pdf). The client's filename is only kept in the state.
+The state lives on disk so any gunicorn worker can answer for a job
+submitted to another one, and the queue is the directory itself: a
+worker claims queued jobs (oldest first, under a lock file) only while
+its process pool has a free process, and records itself as their owner;
+the pool process that converts a job takes over as owner. Queued and
+running jobs whose owner process is gone (a recycled or killed worker)
+go back to the queue, up to MAX_ATTEMPTS times, and any worker claims
+them on its next submit, finished conversion or status poll. Owners are
+pids, so the directory must not be shared between hosts.
+
+job.json: {"id", "filename", "key", "status": queued|running|done|error,
+           "cached", "submitted", "started", "finished", "errors_found",
+           "error", "owner", "attempts"}
+
+With a ResultCache, key is the cache key of the upload: an upload whose
+PDF is cached becomes a done job at once (cached: true, errors_found
+unknown), and converted PDFs are moved into the cache.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.utils import secure_filename
+from apd import apd2pdf
+from apd import fixed_text_file as ftf
+from apd import metrics
+from apd.flask.cache import new_hash
+
+STATE = 'job.json'
+INPUT = 'input'
+OUTPUT = 'output.pdf'
+LOCK = '.lock'
+JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+# conversions of a job started before its owner died, then failed
+MAX_ATTEMPTS = 3
+
+
+def read_state(jobdir):
+    with open(os.path.join(jobdir, STATE), encoding='utf-8') as fil:
+        return json.load(fil)
+
+
+def write_state(jobdir, state):
+    """Replace job.json atomically, readers never see half a file"""
+    tmp = os.path.join(jobdir, f'{STATE}.{os.getpid()}')
+    with open(tmp, 'w', encoding='utf-8') as fil:
+        json.dump(state, fil, ensure_ascii=False)
+    os.replace(tmp, os.path.join(jobdir, STATE))
+
+
+def update_state(jobdir, **values):
+    state = read_state(jobdir)
+    state.update(values)
+    write_state(jobdir, state)
+    return state
+
+
+@contextmanager
+def locked(directory):
+    """Exclusive lock of the queue in directory, across processes"""
+    import fcntl  # Unix only, as are the servers with many processes
+    with open(os.path.join(directory, LOCK), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def pool_context():
+    """forkserver (spawn where missing): pool processes are not forks
+    of a threaded web worker, and outlive it to finish their job"""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        'forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def convert(jobdir, cache=None):
+    """Convert the upload of a job (runs in the pool processes)"""
+    with locked(os.path.dirname(jobdir)):
+        state = update_state(jobdir, status='running', started=time.time(),
+                             owner=os.getpid())
+    try:
+        apd = ftf.apd_builder(shared=True)
+        with metrics.stage('parse'):
+            apd.parse(os.path.join(jobdir, INPUT))
+        errors = apd.errors_found()
+        pdf = apd2pdf.build_document(apd)
+        outfile = os.path.join(jobdir, OUTPUT)
+        with metrics.stage('output'):
+            pdf.output(outfile, 'F')
+        if cache is not None:
+            cache.put(state['key'], outfile)
+    except Exception as err:
+        update_state(jobdir, status='error', finished=time.time(),
+                     error=f'{type(err).__name__}: {err}')
+        metrics.inc('apd_jobs_total', status='error')
+    else:
+        update_state(jobdir, status='done', finished=time.time(),
+                     errors_found=errors)
+        metrics.inc('apd_jobs_total', status='done')
+    metrics.flush()
+
+
+def _job_failed(jobdir, future):
+    """Mark the job failed if its process died before it could"""
+    if future.cancelled():
+        error = 'Cancelled'
+    elif future.exception() is not None:
+        err = future.exception()
+        error = f'{type(err).__name__}: {err}'
+    else:
+        error = None
+    if error is None:
+        return
+    try:
+        with locked(os.path.dirname(jobdir)):
+            state = read_state(jobdir)
+            owner = state.get('owner')
+            # unless another worker has put it back in the queue already
+            if state['status'] in ('queued', 'running') and \
+                    owner is not None and \
+                    (owner == os.getpid() or not _alive(owner)):
+                update_state(jobdir, status='error', finished=time.time(),
+                             error=error)
+                metrics.inc('apd_jobs_total', status='error')
+    except (OSError, ValueError):
+        pass
+
+
+class JobQueue:
+    """Conversions in the background, with their state on the filesystem
+
+    :param directory: where the jobs are kept
+    :param workers: size of the process pool (per web worker process),
+        and so the most jobs a worker claims at a time
+    :param keep: seconds after which finished jobs are deleted
+    :param timeout: seconds after which unfinished jobs are failed
+    :param cache: optional ResultCache for the PDFs
+    """
+
+    def __init__(self, directory, workers=2, keep=24 * 3600, timeout=3600,
+                 cache=None):
+        self.directory = directory
+        self.workers = workers
+        self.keep = keep
+        self.timeout = timeout
+        self.cache = cache
+        os.makedirs(directory, exist_ok=True)
+        # a retiring worker finishes its jobs but claims no new ones
+        self.draining = False
+        self._pool = None
+        self._pid = None
+        self._claimed = set()
+        self._polled = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        # created on first use in each process, never inherited by a fork
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    self.workers, mp_context=pool_context(),
+                    initializer=apd2pdf.warm_up)
+                self._pid = os.getpid()
+                self._claimed = set()
+            return self._pool
+
+    @property
+    def busy(self):
+        """Number of jobs claimed by this process and not finished"""
+        with self._lock:
+            return len(self._claimed) if self._pid == os.getpid() else 0
+
+    def _replace_pool(self, broken):
+        """A new pool in place of broken (unless a thread replaced it)"""
+        with self._lock:
+            if self._pool is broken:
+                broken.shutdown(wait=False)
+                self._pid = None
+        return self.pool
+
+    def _start(self, jobdir):
+        pool = self.pool
+        try:
+            future = pool.submit(convert, jobdir, self.cache)
+        except BrokenProcessPool:
+            # a pool process died (killed, out of memory): start over
+            future = self._replace_pool(pool).submit(
+                convert, jobdir, self.cache)
+        metrics.inc('apd_jobs_in_flight')
+        future.add_done_callback(partial(self._finished, jobdir))
+
+    def _finished(self, jobdir, future):
+        metrics.inc('apd_jobs_in_flight', -1)
+        _job_failed(jobdir, future)
+        metrics.flush()
+        with self._lock:
+            self._claimed.discard(jobdir)
+        # the pool has a free process for the next queued job
+        threading.Thread(target=self.dispatch, daemon=True).start()
+
+    def _jobs(self):
+        """(jobdir, state) of every readable job"""
+        for job_id in os.listdir(self.directory):
+            jobdir = self.jobdir(job_id)
+            if jobdir is None:
+                continue
+            try:
+                yield jobdir, read_state(jobdir)
+            except (OSError, ValueError):
+                continue
+
+    def dispatch(self):
+        """Claim queued jobs while the pool has free processes
+
+        Unfinished jobs of dead owners are put back in the queue first
+        (failed after MAX_ATTEMPTS).
+        """
+        self._polled = time.time()
+        self.pool  # a new process starts with nothing claimed
+        claimed = []
+        with locked(self.directory):
+            with self._lock:
+                free = 0 if self.draining else \
+                    self.workers - len(self._claimed)
+            queued = []
+            for jobdir, state in self._jobs():
+                if state['status'] not in ('queued', 'running'):
+                    continue
+                owner = state.get('owner')
+                if owner is not None:
+                    if _alive(owner):
+                        continue
+                    attempts = state.get('attempts', 0) + (
+                        state['status'] == 'running')
+                    if attempts >= MAX_ATTEMPTS:
+                        update_state(
+                            jobdir, status='error', finished=time.time(),
+                            error='Its process died, too many attempts')
+                        continue
+                    state = update_state(jobdir, status='queued', owner=None,
+                                         started=None, attempts=attempts)
+                queued.append((state['submitted'], jobdir))
+            for _, jobdir in sorted(queued)[:max(free, 0)]:
+                update_state(jobdir, owner=os.getpid())
+                claimed.append(jobdir)
+        with self._lock:
+            self._claimed.update(claimed)
+        for jobdir in claimed:
+            self._start(jobdir)
+
+    def jobdir(self, job_id):
+        """Directory of job_id, None for ids that are not ours"""
+        if not JOB_ID.match(job_id or ''):
+            return None
+        path = os.path.join(self.directory, job_id)
+        return path if os.path.isdir(path) else None
+
+    def submit(self, upload, filename):
+        """Queue the conversion of upload (a file object), return its id"""
+        self.purge()
+        job_id = uuid.uuid4().hex
+        jobdir = os.path.join(self.directory, job_id)
+        os.mkdir(jobdir)
+        filename = secure_filename(filename) or 'CSL01'
+        upload_path = os.path.join(jobdir, INPUT)
+        digest = new_hash()
+        with metrics.stage('save'), open(upload_path, 'wb') as fil:
+            for chunk in iter(lambda: upload.read(1 << 16), b''):
+                digest.update(chunk)
+                fil.write(chunk)
+            metrics.observe('apd_input_bytes', fil.tell())
+        now = time.time()
+        state = {
+            'id': job_id, 'filename': filename, 'key': digest.hexdigest(),
+            'status': 'queued', 'cached': False, 'submitted': now,
+            'started': None, 'finished': None, 'errors_found': None,
+            'error': None, 'owner': None, 'attempts': 0}
+        if self.cache is not None:
+            cached = self.cache.get(state['key']) is not None
+            metrics.inc('apd_cache_lookups_total',
+                        result='hit' if cached else 'miss')
+            if cached:
+                os.remove(upload_path)
+                state.update(status='done', cached=True, finished=now)
+                write_state(jobdir, state)
+                return job_id
+        write_state(jobdir, state)
+        self.dispatch()
+        return job_id
+
+    def status(self, job_id, poll=1.0):
+        """State of job_id, None if there is no such job
+
+        An unfinished job makes this worker look for jobs to claim, at
+        most every poll seconds, so jobs left queued by a worker that
+        went away are picked up while their clients wait.
+        """
+        jobdir = self.jobdir(job_id)
+        if jobdir is None:
+            return None
+        state = read_state(jobdir)
+        if state['finished'] is None and time.time() - self._polled > poll:
+            self.dispatch()
+            state = read_state(jobdir)
+        return state
+
+    def result(self, job_id):
+        """Path of the PDF of a finished job, else None"""
+        state = self.status(job_id)
+        if state is None or state['status'] != 'done':
+            return None
+        if self.cache is not None:
+            return self.cache.get(state['key'])
+        return os.path.join(self.directory, job_id, OUTPUT)
+
+    def purge(self):
+        """Delete the jobs that finished more than keep seconds ago
+
+        Jobs still unfinished timeout seconds after they were submitted
+        (their process is gone) are marked failed, then deleted in turn.
+        """
+        now = time.time()
+        for jobdir, state in self._jobs():
+            if state['finished'] is None:
+                if state['submitted'] < now - self.timeout:
+                    try:
+                        update_state(jobdir, status='error', finished=now,
+                                     error='Timed out')
+                    except (OSError, ValueError):
+                        pass
+                continue
+            if state['finished'] < now - self.keep:
+                shutil.rmtree(jobdir, ignore_errors=True)
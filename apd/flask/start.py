@@ -1,14 +1,85 @@
 import os
-from flask import Flask, request, render_template, url_for
-from werkzeug.utils import secure_filename
-from apd import apd2pdf
+import time
+import zipfile
+from functools import partial
+from tempfile import SpooledTemporaryFile
+from flask import (Flask, Request, Response, request, render_template,
+                   url_for, jsonify, send_file, current_app, g)
+from apd import apd2pdf, metrics
+from apd.flask.jobs import JobQueue
+from apd.flask.cache import ResultCache, new_hash
+from apd.flask.api import api
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+
+class UploadRequest(Request):
+    """Keeps uploads in memory up to SPILL_BYTES, on disk beyond"""
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return SpooledTemporaryFile(
+            max_size=current_app.config['SPILL_BYTES'], mode='rb+')
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
+app.register_blueprint(api)
 
 app.config['CORS_HEADERS'] = 'Content-Type'
-app.config['UPLOAD_FOLDER'] = os.path.join(dir_path, 'static')
+app.config['JOBS_FOLDER'] = os.environ.get(
+    'APD_JOBS_FOLDER', os.path.join(dir_path, 'jobs'))
+app.config['JOB_WORKERS'] = int(os.environ.get('APD_JOB_WORKERS', 2))
+# uploads up to INLINE_BYTES are converted in memory, within the request
+app.config['INLINE_BYTES'] = int(os.environ.get('APD_INLINE_BYTES', 1 << 18))
+app.config['SPILL_BYTES'] = int(os.environ.get('APD_SPILL_BYTES', 1 << 23))
+# larger request bodies are refused with 413 before they are read
+app.config['MAX_CONTENT_LENGTH'] = int(
+    os.environ.get('APD_MAX_UPLOAD_BYTES', 1 << 27))
+app.config['CACHE_FOLDER'] = os.environ.get(
+    'APD_CACHE_FOLDER', os.path.join(dir_path, 'cache'))
+app.config['CACHE_BYTES'] = int(os.environ.get('APD_CACHE_BYTES', 1 << 30))
+app.config['CACHE_ENTRIES'] = int(os.environ.get('APD_CACHE_ENTRIES', 1000))
+
+# fonts and schema are loaded once here, before gunicorn --preload forks
+apd2pdf.warm_up()
+
+cache = ResultCache(app.config['CACHE_FOLDER'], app.config['CACHE_BYTES'],
+                    app.config['CACHE_ENTRIES'])
+jobs = JobQueue(app.config['JOBS_FOLDER'], app.config['JOB_WORKERS'],
+                cache=cache)
+
+
+def job_urls(job_id):
+    return {
+        'id': job_id,
+        'status_url': url_for('job_status', job_id=job_id),
+        'download_url': url_for('job_pdf', job_id=job_id),
+    }
+
+
+@app.before_request
+def start_timer():
+    if metrics.ENABLED:
+        g.started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    if metrics.ENABLED and 'started' in g:
+        metrics.observe('apd_request_seconds',
+                        time.perf_counter() - g.started,
+                        endpoint=request.endpoint or 'none')
+        metrics.flush()
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not metrics.ENABLED:
+        return jsonify(error='Metrics are off (APD_METRICS=1)'), 404
+    return Response(metrics.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 @app.route('/')
@@ -20,12 +91,72 @@ def upload_file():
 def getpdf():
     if request.method == 'POST':
         f = request.files['file']
-        secure_name = secure_filename(f.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_name)
-        f.save(file_path)
-        outfile = apd2pdf.run(file_path)
-        fout = f'{app.static_url_path}/{os.path.basename(outfile)}'
-        return render_template('uploader.html', file_path=fout)
+        f.stream.seek(0, os.SEEK_END)
+        size = f.stream.tell()
+        f.stream.seek(0)
+        if size > app.config['INLINE_BYTES']:
+            job_id = jobs.submit(f.stream, f.filename)
+            return render_template('uploader.html', **job_urls(job_id))
+        metrics.observe('apd_input_bytes', size)
+        with metrics.stage('save'):
+            data = f.stream.read()
+        digest = new_hash()
+        digest.update(data)
+        key = digest.hexdigest()
+        path = cache.get(key)
+        metrics.inc('apd_cache_lookups_total',
+                    result='miss' if path is None else 'hit')
+        if path is not None:
+            return send_file(path, mimetype='application/pdf', etag=key)
+        # parsed and rendered in memory, then kept for repeat uploads
+        try:
+            pdf = apd2pdf.run(data)
+        except (ValueError, KeyError, zipfile.BadZipFile) as err:
+            return Response(f'{f.filename}: {err}', 400, mimetype='text/plain')
+        resp = Response(pdf, mimetype='application/pdf')
+        resp.set_etag(key)
+        # written to the cache once the response is sent, not before
+        resp.call_on_close(partial(cache.store, key, pdf))
+        return resp.make_conditional(request)
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    f = request.files['file']
+    job_id = jobs.submit(f.stream, f.filename)
+    return jsonify(status='queued', **job_urls(job_id)), 202
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    state = jobs.status(job_id)
+    if state is None:
+        return jsonify(error='No such job'), 404
+    return jsonify(state)
+
+
+@app.route('/jobs/<job_id>/pdf')
+def job_pdf(job_id):
+    state = jobs.status(job_id)
+    if state is None:
+        return jsonify(error='No such job'), 404
+    if state['status'] != 'done':
+        return jsonify(state), 409
+    path = jobs.result(job_id)
+    if path is None:
+        return jsonify(error='The PDF is no longer available'), 410
+    # the cache key identifies the content, so it is a strong ETag
+    return send_file(path, mimetype='application/pdf', etag=state['key'],
+                     download_name=f"{state['filename']}.pdf")
+
+
+@app.route('/pdf/<key>')
+def cached_pdf(key):
+    path = cache.get(key)
+    if path is None:
+        return jsonify(error='No such PDF'), 404
+    return send_file(path, mimetype='application/pdf', etag=key,
+                     max_age=365 * 24 * 3600)
 
 
 if __name__ == '__main__':
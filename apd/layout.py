@@ -0,0 +1,138 @@
+"""Pagination of the PDF report, computed without laying it out
+
+Every report line is a LINE_HEIGHT cell, so where a line lands follows
+from line counts: page 1 is the cover, page 2 holds the company data and
+the first report lines, every next page the same number of lines. The
+report is an employee block and a payroll block per payroll line, and a
+linetype always formats to the same number of lines.
+
+ReportLayout knows the page of every line and employee, and renders any
+range of pages on its own, formatting only the records on those pages.
+"""
+import math
+from bisect import bisect_right
+from . import apd2pdf
+from . import fixed_text_file as ftf
+
+# signature lines after the last payroll block (see apd2pdf.report_lines)
+SIGNATURE_LINES = 3
+
+
+class ReportLayout:
+    """Page map of the report of a parsed Document"""
+
+    def __init__(self, apd, fast=True):
+        self.apd = apd
+        self.fast = fast
+        self.employees = [erg for erg, apods in apd.ergnoi.items() if apods]
+        # index of the first payroll block pair of every employee
+        self.first_pair = []
+        pairs = 0
+        for erg in self.employees:
+            self.first_pair.append(pairs)
+            pairs += len(apd.ergnoi[erg])
+        self.pairs = pairs
+        if pairs:
+            erg = self.employees[0]
+            erline = apd.lines[erg]
+            apline = apd.lines[apd.ergnoi[erg][0]]
+            self.pair_lines = (
+                len(apd.linetypes[erline['line_code']].for_report(erline))
+                + len(apd.linetypes[apline['line_code']].for_report(apline)))
+        else:
+            self.pair_lines = 0
+        self.lines = pairs * self.pair_lines + SIGNATURE_LINES
+        self.first_lines = apd2pdf.start_report(apd, fast).lines_fitting()
+        self.page_lines = apd2pdf.report_page_lines(apd.print_header())
+        self.pages = 2 + math.ceil(
+            max(0, self.lines - self.first_lines) / self.page_lines)
+
+    def page_of_line(self, line):
+        """Page of report line number line (0 is the first)"""
+        if line < self.first_lines:
+            return 2
+        return 3 + (line - self.first_lines) // self.page_lines
+
+    def line_range(self, page):
+        """First and past the last report line on page"""
+        if page < 2:
+            return 0, 0
+        if page == 2:
+            return 0, min(self.first_lines, self.lines)
+        start = self.first_lines + (page - 3) * self.page_lines
+        return start, min(start + self.page_lines, self.lines)
+
+    def page_map(self):
+        """{'2' line index: (first page, last page)} of every employee"""
+        pages = {}
+        for num, erg in enumerate(self.employees):
+            first = self.first_pair[num] * self.pair_lines
+            last = first + len(self.apd.ergnoi[erg]) * self.pair_lines - 1
+            pages[erg] = (self.page_of_line(first), self.page_of_line(last))
+        return pages
+
+    def employee_page(self, amka=None, afm=None, ama=None):
+        """First page of an employee (None if not found)"""
+        for erg in self.apd._employee_lines(amka, afm, ama):
+            if self.apd.ergnoi[erg]:
+                num = self.employees.index(erg)
+                return self.page_of_line(self.first_pair[num] * self.pair_lines)
+        return None
+
+    def _blocks(self, first, last):
+        """for_report() blocks of the payroll pairs first..last-1"""
+        apd = self.apd
+        for pair in range(first, last):
+            num = bisect_right(self.first_pair, pair) - 1
+            erg = self.employees[num]
+            erline = apd.lines[erg]
+            apline = apd.lines[apd.ergnoi[erg][pair - self.first_pair[num]]]
+            yield apd.linetypes[erline['line_code']].for_report(erline)
+            yield apd.linetypes[apline['line_code']].for_report(apline)
+
+    def report_lines(self, start, end):
+        """Report lines start..end-1, formatting only the records needed"""
+        if start >= end:
+            return []
+        size = self.pair_lines or 1
+        first = min(start // size, self.pairs)
+        last = min(math.ceil(end / size), self.pairs)
+        lines = list(apd2pdf.report_lines(self._blocks(first, last)))
+        if last < self.pairs:
+            # the signature lines only follow the last pair
+            del lines[-SIGNATURE_LINES:]
+        skip = start - first * size
+        return lines[skip:skip + end - start]
+
+    def render_pages(self, start, end=None):
+        """PDF with pages start..end (inclusive, 1 is the cover)"""
+        end = min(self.pages, start if end is None else end)
+        start = max(1, start)
+        if start > end:
+            raise ValueError(f'No pages {start}..{end} in {self.pages}')
+        if start > 2:
+            first, _ = self.line_range(start)
+            _, last = self.line_range(end)
+            pdf = apd2pdf.PDF(self.apd.print_header())
+            pdf.page_offset = start - 1
+            pdf.page_total = self.pages
+            pdf.header = pdf.heada1
+            pdf.set_font('fnormal', '', 10)
+            pdf.fast = self.fast
+            pdf.add_page()
+            pdf.write_report(self.report_lines(first, last))
+            return pdf
+        _, last = self.line_range(end)
+        pdf = apd2pdf.start_report(self.apd, self.fast, page_total=self.pages)
+        pdf.write_report(self.report_lines(0, last))
+        apd2pdf.finish_report(pdf, self.apd)
+        if (start, end) != (1, pdf.page):
+            pdf.keep_pages(start, end)
+        return pdf
+
+
+def plan(apd_file, fast=True):
+    """Parse apd_file and plan its report"""
+    apd = ftf.apd_builder(shared=True)
+    apd.parse(apd_file)
+    return ReportLayout(apd, fast)
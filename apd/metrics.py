@@ -0,0 +1,307 @@
+"""Counters, gauges and histograms, exposed in the Prometheus text format
+
+Off unless the environment has APD_METRICS=1: then every recording
+function returns at its first line and stage() hands out one shared
+no-op context manager, so the instrumentation can stay in the code.
+
+    with metrics.stage('output'):          # apd_stage_seconds{stage=...}
+        data = pdf.output()
+    metrics.observe('apd_input_bytes', len(data))
+    metrics.inc('apd_cache_lookups_total', result='hit')
+
+Values live in the process that records them. With APD_METRICS_DIR set,
+flush() writes the process's values to <dir>/<pid>.json and render()
+adds up the files of all the processes (gunicorn workers, conversion
+pools): counters and histograms of every process that ever ran, gauges
+of the live ones only.
+"""
+import os
+import json
+import time
+from bisect import bisect_left
+from threading import Lock
+
+ENABLED = os.environ.get('APD_METRICS', '') not in ('', '0')
+DIRECTORY = os.environ.get('APD_METRICS_DIR') or None
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(1 << bits for bits in range(10, 29, 2))
+COUNT_BUCKETS = (10, 100, 1000, 10_000, 100_000, 1_000_000)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'apd_stage_seconds': (
+        'histogram', 'Time per conversion stage: save (upload to disk), '
+        'parse (when streamed, with formatting), report (for_report), '
+        'layout, output (pdf.output), scan (/api)', TIME_BUCKETS),
+    'apd_request_seconds': (
+        'histogram', 'Time per HTTP request, by endpoint', TIME_BUCKETS),
+    'apd_input_bytes': (
+        'histogram', 'Size of the uploaded APD files', SIZE_BUCKETS),
+    'apd_records': (
+        'histogram', 'Employee and payroll records per converted document',
+        COUNT_BUCKETS),
+    'apd_pdf_pages': (
+        'histogram', 'Pages per generated PDF', COUNT_BUCKETS),
+    'apd_cache_lookups_total': (
+        'counter', 'PDF cache lookups of uploads, by result (hit, miss)',
+        None),
+    'apd_jobs_total': (
+        'counter', 'Finished background conversions, by status', None),
+    'apd_jobs_in_flight': (
+        'gauge', 'Background conversions queued or running', None),
+}
+
+_lock = Lock()
+# (name, labels) -> number, or [bucket counts..., +Inf count, sum]
+_values = {}
+
+
+def _reset():
+    global _lock
+    _lock = Lock()
+    _values.clear()
+
+
+# a forked process starts from zero, its parent reports its own values
+os.register_at_fork(after_in_child=_reset)
+
+
+def enable(directory=None):
+    """Start recording (as APD_METRICS=1 does), values from zero"""
+    global ENABLED, DIRECTORY
+    ENABLED = True
+    DIRECTORY = directory
+    _reset()
+
+
+def disable():
+    """Stop recording, forgetting the values"""
+    global ENABLED, DIRECTORY
+    ENABLED = False
+    DIRECTORY = None
+    _reset()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Add value to a counter or gauge"""
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """Count value in a histogram"""
+    if not ENABLED:
+        return
+    buckets = METRICS[name][2]
+    key = _key(name, labels)
+    with _lock:
+        counts = _values.get(key)
+        if counts is None:
+            counts = _values[key] = [0] * (len(buckets) + 2)
+        counts[bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+
+class Stage:
+    """Times its with block into apd_stage_seconds
+
+    exclude: a timed() iterator consumed inside the block, its time is
+    not counted (it is recorded as a stage of its own).
+    """
+    __slots__ = ('name', 'exclude', 'start')
+
+    def __init__(self, name, exclude=None):
+        self.name = name
+        self.exclude = exclude
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        if self.exclude is not None:
+            elapsed -= self.exclude.elapsed
+        observe('apd_stage_seconds', elapsed, stage=self.name)
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NO_STAGE = _NoStage()
+
+
+def stage(name, exclude=None):
+    """Context manager timing a stage (a no-op when disabled)"""
+    return Stage(name, exclude) if ENABLED else NO_STAGE
+
+
+class Timed:
+    """Iterator recording the time spent producing the items of iterable"""
+
+    def __init__(self, iterable, name):
+        self.iterator = iter(iterable)
+        self.name = name
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            item = next(self.iterator)
+        except StopIteration:
+            self.elapsed += time.perf_counter() - start
+            observe('apd_stage_seconds', self.elapsed, stage=self.name)
+            raise
+        self.elapsed += time.perf_counter() - start
+        return item
+
+
+def timed(iterable, name):
+    """iterable, timed as stage name once exhausted when enabled"""
+    return Timed(iterable, name) if ENABLED else iterable
+
+
+def snapshot():
+    """The values of this process, as JSON-able [name, labels, value]"""
+    with _lock:
+        return [[name, list(labels), list(val) if isinstance(val, list)
+                 else val]
+                for (name, labels), val in _values.items()]
+
+
+def flush():
+    """Write this process's values to DIRECTORY (if set)"""
+    if not ENABLED or DIRECTORY is None:
+        return
+    os.makedirs(DIRECTORY, exist_ok=True)
+    path = os.path.join(DIRECTORY, f'{os.getpid()}.json')
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as fil:
+        json.dump(snapshot(), fil)
+    os.replace(f'{path}.tmp', path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add(totals, entries, gauges=True):
+    for name, labels, val in entries:
+        if not gauges and METRICS[name][0] == 'gauge':
+            continue
+        key = name, tuple(tuple(pair) for pair in labels)
+        old = totals.get(key)
+        if old is None:
+            totals[key] = val
+        elif isinstance(val, list):
+            totals[key] = [a + b for a, b in zip(old, val)]
+        else:
+            totals[key] = old + val
+
+
+def collect():
+    """{(name, labels): value} of this process, or of all in DIRECTORY
+
+    The files of exited processes are folded into dead.json (without
+    their gauges), so the directory does not grow with recycled workers.
+    """
+    if DIRECTORY is None:
+        totals = {}
+        _add(totals, snapshot())
+        return totals
+    import fcntl  # Unix only, as are the servers with many processes
+    flush()
+    totals = {}
+    with open(os.path.join(DIRECTORY, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        dead_path = os.path.join(DIRECTORY, 'dead.json')
+        dead = {}
+        if os.path.exists(dead_path):
+            with open(dead_path, encoding='utf-8') as fil:
+                _add(dead, json.load(fil))
+        dead_files = []
+        for entry in os.scandir(DIRECTORY):
+            pid, ext = os.path.splitext(entry.name)
+            if ext != '.json' or not pid.isdigit():
+                continue
+            try:
+                with open(entry.path, encoding='utf-8') as fil:
+                    entries = json.load(fil)
+            except (OSError, ValueError):
+                continue
+            if _alive(int(pid)):
+                _add(totals, entries)
+            else:
+                _add(dead, entries, gauges=False)
+                dead_files.append(entry.path)
+        if dead_files:
+            with open(f'{dead_path}.tmp', 'w', encoding='utf-8') as fil:
+                json.dump([[name, list(labels), val]
+                           for (name, labels), val in dead.items()], fil)
+            os.replace(f'{dead_path}.tmp', dead_path)
+            for path in dead_files:
+                os.remove(path)
+    _add(totals, [[name, list(labels), val]
+                  for (name, labels), val in dead.items()])
+    return totals
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(val).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for key, val in pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """All the metrics in the Prometheus text exposition format"""
+    totals = collect()
+    out = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        out.append(f'# HELP {name} {help_text}')
+        out.append(f'# TYPE {name} {kind}')
+        for (key_name, labels), val in sorted(totals.items()):
+            if key_name != name:
+                continue
+            if kind != 'histogram':
+                out.append(f'{name}{_labels(labels)} {_number(val)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), val[:-1]):
+                cumulative += count
+                out.append(f'{name}_bucket'
+                           f'{_labels(labels, [("le", bound)])} {cumulative}')
+            out.append(f'{name}_sum{_labels(labels)} {_number(val[-1])}')
+            out.append(f'{name}_count{_labels(labels)} {cumulative}')
+    return '\n'.join(out) + '\n'
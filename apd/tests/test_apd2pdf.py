@@ -0,0 +1,44 @@
+import os
+from apd import apd2pdf
+from apd import fixed_text_file as ftf
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+def test_fast_layout_matches_cells():
+    bfile = os.path.join(dir_path, 'CSL01')
+    fast = apd2pdf.build(bfile)
+    cells = apd2pdf.build(bfile, fast=False)
+    assert fast.page == cells.page == 8
+    assert fast.y == cells.y
+    # fpdf's own write() is left alone
+    assert 'write' not in vars(fast) and not cells.fast
+    assert bytes(fast.output()).startswith(b'%PDF')
+
+
+def test_fonts_loaded_once():
+    apd2pdf.warm_up()
+    first = apd2pdf.PDF('')
+    second = apd2pdf.PDF('')
+    assert first.fonts['fnormal']['cw'] is second.fonts['fnormal']['cw']
+    assert first.fonts['fnormal']['subset'] is not second.fonts['fnormal']['subset']
+
+
+def test_parallel_pages_match_serial(monkeypatch):
+    monkeypatch.setattr(apd2pdf, 'PARALLEL_MIN_PAGES', 0)
+    bfile = os.path.join(dir_path, 'CSL01')
+    apd = ftf.apd_builder()
+    apd.parse(bfile)
+    serial = apd2pdf.build_document(apd)
+    parallel = apd2pdf.build(bfile, jobs=2)
+    serial.output()
+    parallel.output()
+    assert parallel.page == 2
+    assert [p['content'] for p in parallel.pages.values()] == \
+        [p['content'] for p in serial.pages.values()]
+
+
+def test_run_bytes():
+    with open(os.path.join(dir_path, 'CSL01'), 'rb') as fil:
+        pdf = apd2pdf.run(fil)
+    assert pdf.startswith(b'%PDF')
@@ -0,0 +1,68 @@
+import io
+import os
+import sys
+import zipfile
+import subprocess
+import pytest
+
+pytest.importorskip('flask')
+from flask import Flask  # noqa: E402
+from apd.flask.api import api  # noqa: E402
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    return app.test_client()
+
+
+def csl01():
+    with open(os.path.join(dir_path, 'CSL01'), 'rb') as fil:
+        return fil.read()
+
+
+def test_api_without_fpdf():
+    code = 'import sys, apd.flask.api; print("fpdf" in sys.modules)'
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                         check=True, text=True).stdout
+    assert out.strip() == 'False'
+
+
+def test_validate(client):
+    resp = client.post('/api/validate', data=csl01())
+    assert resp.get_json() == {
+        'valid': True, 'errors_found': [], 'employees': 12}
+
+
+def test_totals(client):
+    resp = client.post('/api/totals', data={
+        'file': (io.BytesIO(csl01()), 'CSL01')})
+    data = resp.get_json()
+    assert data['totals'] == {'meres': 16, 'apodoxes': 695.0,
+                              'eisfores': 309.95}
+    assert data['employees'] == 12
+    assert data['errors_found'] == []
+    assert set(data['totals_by_18']) == {'18', 'no'}
+
+
+def test_zipped_upload(tmp_path, monkeypatch):
+    # through the app, whose uploads are SpooledTemporaryFile streams
+    from apd.flask import start
+    from apd.flask.cache import ResultCache
+    monkeypatch.setattr(start, 'cache', ResultCache(str(tmp_path)))
+    client = start.app.test_client()
+    zdata = io.BytesIO()
+    with zipfile.ZipFile(zdata, 'w') as zfl:
+        zfl.writestr('CSL01', csl01())
+    zdata.seek(0)
+    resp = client.post('/api/validate', data={'file': (zdata, 'CSL01.zip')})
+    assert resp.get_json()['employees'] == 12
+
+
+def test_bad_upload(client):
+    resp = client.post('/api/totals', data=b'not an apd')
+    assert resp.status_code == 400
+    assert 'error' in resp.get_json()
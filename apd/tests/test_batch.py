@@ -0,0 +1,25 @@
+import os
+import shutil
+from apd import batch
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+def test_batch(tmp_path):
+    for name in ('a', 'b'):
+        os.mkdir(tmp_path / name)
+        shutil.copy(os.path.join(dir_path, 'CSL01'), tmp_path / name)
+    (tmp_path / 'b' / 'CSL01.bad').write_text('1garbage\n')
+    manifest = tmp_path / 'list.txt'
+    manifest.write_text(f"# month end\n{tmp_path / 'a' / 'CSL01'}\n")
+    files = batch.expand([str(tmp_path / 'b')], str(manifest))
+    assert [os.path.relpath(i, tmp_path) for i in files] == [
+        os.path.join('b', 'CSL01'), os.path.join('b', 'CSL01.bad'),
+        os.path.join('a', 'CSL01')]
+    summary = batch.run(files, jobs=2)
+    assert (summary['ok'], summary['skipped'], summary['error']) == (2, 0, 1)
+    assert summary['files'][0]['errors_found'] == []
+    assert summary['files'][1]['error'].startswith('ValueError')
+    assert os.path.exists(tmp_path / 'a' / 'CSL01.pdf')
+    again = batch.run(files)
+    assert [i['status'] for i in again['files']] == ['skipped', 'error', 'skipped']
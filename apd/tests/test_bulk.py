@@ -0,0 +1,68 @@
+import os
+import pytest
+from apd import fixed_text_file as ftf
+
+np = pytest.importorskip('numpy')
+from apd import bulk  # noqa: E402
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+def test_bulk_totals():
+    bfile = os.path.join(dir_path, 'CSL01')
+    apd = ftf.apd_builder()
+    apd.parse(bfile)
+    table = bulk.load(bfile)
+    assert table.count == 12
+    assert table.document.total_ergnoi == apd.total_ergnoi
+    assert table.get_totals() == apd.get_totals()
+    assert table.totals_by_18()['no'] == apd.totals_by_18()['no']
+    assert not table.errors_found()
+    assert table.column('kpk').dtype == np.int64
+    assert table.records['apodoxes_type'][0] == b'001'
+    with pytest.raises(ValueError):
+        table.column('apoapasxolisi')
+
+
+def test_bulk_cents():
+    table = bulk.load(os.path.join(dir_path, 'CSL01'),
+                      ftf.apd_builder(cents=True))
+    assert table.get_totals() == (69500, 30995, 16)
+    assert not table.errors_found()
+
+
+def test_bulk_rejects_bad_digits():
+    with open(os.path.join(dir_path, 'CSL01'), 'rb') as fil:
+        lines = fil.read().splitlines(keepends=True)
+    table = bulk.load(b''.join(lines))
+    linetype = table.linetype
+    _, apo, eos, _ = linetype.slices[
+        linetype.columns.index(linetype.colbyname['apodoxes'])]
+    num = next(i for i, lin in enumerate(lines) if lin.startswith(b'3'))
+    for field in (b'X', b'1 1', b' ' * (eos - apo)):
+        bad = bytearray(lines[num])
+        bad[eos - len(field):eos] = field
+        data = b''.join(lines[:num] + [bytes(bad)] + lines[num + 1:])
+        with pytest.raises(ValueError):
+            ftf.apd_builder().parse(data)
+        with pytest.raises(ValueError, match='payroll line 1: apodoxes'):
+            bulk.load(data).get_totals()
+    for padded_at in (apo, eos - 2):
+        padded = bytearray(lines[num])
+        padded[padded_at:padded_at + 2] = b'  '
+        data = b''.join(lines[:num] + [bytes(padded)] + lines[num + 1:])
+        apd = ftf.apd_builder()
+        apd.parse(data)
+        assert bulk.load(data).get_totals() == apd.get_totals()
+
+
+def test_bulk_mix():
+    data = bulk.sample_mix(3000)
+    apd = ftf.apd_builder(cents=True)
+    apd.scan(data)
+    table = bulk.load(data, ftf.apd_builder(cents=True))
+    assert (table.count, table.document.total_ergnoi) == (4000, 3000)
+    assert table.totals_by_18() == apd.totals_by_18()
+    # the employee lines are counted, not parsed
+    best = bulk.bench(data)
+    assert best['bulk'] < best['scan']
@@ -0,0 +1,34 @@
+import io
+import os
+import csv
+import json
+from apd import export
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+bfile = os.path.join(dir_path, 'CSL01')
+
+
+def test_csv_and_jsonl():
+    stream = io.StringIO()
+    assert export.write_csv(bfile, stream) == 12
+    rows = list(csv.DictReader(io.StringIO(stream.getvalue())))
+    assert rows[1]['amka'] == '05088202253'
+    assert rows[1]['apodoxes'] == '80.00'
+    assert sum(int(i['apodoxes'].replace('.', '')) for i in rows) == 69500
+    stream = io.StringIO()
+    assert export.write_jsonl(bfile, stream, cents=True) == 12
+    rows = [json.loads(i) for i in stream.getvalue().splitlines()]
+    assert sum(i['apodoxes'] for i in rows) == 69500
+    assert sum(i['katablitees_eisfores'] for i in rows) == 30995
+
+
+def test_columns(tmp_path, monkeypatch):
+    monkeypatch.setattr(export, 'SPILL_ROWS', 5)
+    fname = str(tmp_path / 'apd.col')
+    assert export.export(bfile, fname) == 12
+    with export.ColumnFile(fname) as cols:
+        assert len(cols) == 12
+        assert sum(cols.column('apodoxes')) == 69500
+        assert sum(cols.column('imeres_asfalisis')) == 16
+        assert cols.column('amka')[1] == '05088202253'
+        assert cols.column('asf_gennisi')[-1].isdigit()
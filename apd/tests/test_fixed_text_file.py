@@ -1,4 +1,7 @@
+import io
 import os
+import zipfile
+import pytest
 from apd import fixed_text_file as ftf
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -37,3 +40,274 @@ def test_fixed_text_file_01():
     # print(apd.print_company_data())
     # print(apd.synodeftiko())
     # print(apd.linetypes_report())
+
+
+def test_linetype_dispatch():
+    apd = ftf.apd_builder()
+    assert apd.linetype_for('EOF').name == 'Terminator line'
+    assert apd.linetype_for('3000015540000').name == 'Stoixeia misthodosias'
+    assert apd.linetype_for('9wrong') is None
+    li3 = apd.linetypes['3']
+    assert li3.slices[0][:3] == ('parartima_no', 1, 5)
+    assert li3.slices[-1][2] == li3.size
+
+
+def test_iter_records_zip(tmp_path):
+    bfile = os.path.join(dir_path, 'CSL01')
+    zfile = str(tmp_path / 'apd.zip')
+    with zipfile.ZipFile(zfile, 'w') as zfl:
+        zfl.write(bfile, 'CSL01')
+    apd = ftf.apd_builder()
+    records = list(apd.iter_records(zfile))
+    assert not apd.lines
+    assert [i[0].prefix for i in records[:3]] == ['1', '2', '3']
+    assert records[2][2] is records[1][1]
+    assert records[-1][0].prefix == 'EOF' and records[-1][2] is None
+    assert sum(rec['apodoxes'] for lt, rec, _ in records
+               if lt.prefix == '3') == 695.0
+
+
+def test_slotted_records():
+    apd = ftf.apd_builder()
+    apd.parse(os.path.join(dir_path, 'CSL01'))
+    rec = apd.lines[2]
+    assert not hasattr(rec, '__dict__')
+    assert rec['line_code'] == '3'
+    assert rec['apodoxes'] == 80.0
+    assert dict(rec)['kad'] == '5540'
+    rec['apodoxes'] = 81.0
+    assert rec.get('apodoxes') == 81.0
+    with pytest.raises(KeyError):
+        rec['nonexistent'] = 1
+    for key in ('keys', 'raw', '_raw', '_dirty', 'get', 'nonexistent'):
+        assert key not in rec
+        with pytest.raises(KeyError):
+            rec[key]
+        assert rec.get(key) is None
+
+
+def test_columnar_store():
+    bfile = os.path.join(dir_path, 'CSL01')
+    apd = ftf.apd_builder()
+    apd.parse(bfile)
+    col = ftf.apd_builder(columnar=True)
+    col.parse(bfile)
+    assert isinstance(col.lines, ftf.ColumnStore)
+    assert col.get_totals() == apd.get_totals()
+    assert col.totals_by_18() == apd.totals_by_18()
+    assert list(col.for_report()) == list(apd.for_report())
+    assert col.render() == apd.render()
+    assert [dict(i) for i in col.lines] == [dict(i) for i in apd.lines]
+
+
+def test_cents_money_mode():
+    bfile = os.path.join(dir_path, 'CSL01')
+    apd = ftf.apd_builder()
+    apd.parse(bfile)
+    cents = ftf.apd_builder(cents=True)
+    cents.parse(bfile)
+    assert cents.get_totals() == (69500, 30995, 16)
+    assert all(isinstance(i, int) for i in cents.get_totals())
+    assert not cents.errors_found()
+    assert cents.render() == apd.render()
+    assert cents.totals_by_18_gr() == apd.totals_by_18_gr()
+    assert cents.synodeftiko() == apd.synodeftiko()
+    assert list(cents.for_report()) == list(apd.for_report())
+
+
+def test_lazy_text_columns():
+    apd = ftf.apd_builder(keep_raw=True)
+    apd.parse(os.path.join(dir_path, 'CSL01'))
+    erg = apd.lines[1]
+    assert not hasattr(erg, 'asf_eponymo')
+    assert erg.amka == '29038400767'
+    assert erg['asf_eponymo'] == erg.asf_eponymo != ''
+    with open(os.path.join(dir_path, 'CSL01'), encoding=ftf.ENCODING) as fil:
+        fil.readline()
+        textline = fil.readline().rstrip('\n')
+    assert apd.linetypes['2'].read(textline) == erg
+
+
+def test_records_without_raw():
+    bfile = os.path.join(dir_path, 'CSL01')
+    apd = ftf.apd_builder()
+    apd.parse(bfile)
+    kept = ftf.apd_builder(keep_raw=True)
+    kept.parse(bfile)
+    assert list(apd.lines) == list(kept.lines)
+    assert all(line.raw is None for line in apd.lines)
+    # repeated text is kept once
+    assert apd.lines[2]['kad'] is apd.lines[4]['kad']
+
+
+def test_lazy_records():
+    bfile = os.path.join(dir_path, 'CSL01')
+    apd = ftf.apd_builder()
+    apd.parse(bfile)
+    lazy = ftf.apd_builder()
+    lazy.parse(bfile, lazy=True)
+    assert not hasattr(lazy.lines[2], 'kad')
+    assert lazy.get_totals() == apd.get_totals()
+    assert not hasattr(lazy.lines[2], 'kad')
+    assert hasattr(lazy.lines[2], 'apodoxes')
+    assert list(lazy.for_report()) == list(apd.for_report())
+    assert lazy.render() == apd.render()
+
+
+def test_running_totals():
+    apd = ftf.apd_builder(cents=True)
+    apd.parse(os.path.join(dir_path, 'CSL01'))
+    apd.update_line(2, apodoxes=9000, apodoxes_type='018')
+    assert apd.get_totals() == (70500, 30995, 16)
+    assert apd.totals_by_18()['18'] == [2, 9000, 3245]
+    assert apd.errors_found()
+    apd.correct_header()
+    assert not apd.errors_found()
+    apd.DublicateLines()
+    assert apd.get_totals() == (141000, 61990, 32)
+    before = apd.totals_by_18()
+    apd.refresh_totals()
+    assert apd.totals_by_18() == before
+
+
+def test_update_line_all_or_nothing():
+    apd = ftf.apd_builder()
+    apd.parse(os.path.join(dir_path, 'CSL01'))
+    before = dict(apd.lines[2]), apd.get_totals(), apd.totals_by_18()
+    for values in ({'apodoxes': 1.0, 'bogus': 1},
+                   {'imeres_asfalisis': 5, 'apodoxes': 'x'}):
+        with pytest.raises((KeyError, TypeError)):
+            apd.update_line(2, **values)
+        assert (dict(apd.lines[2]), apd.get_totals(),
+                apd.totals_by_18()) == before
+
+
+def test_employee_index():
+    apd = ftf.apd_builder(columnar=True)
+    apd.parse(os.path.join(dir_path, 'CSL01'))
+    erg = apd.employee(amka='05088202253')
+    assert erg['asf_afm'] == '114749926'
+    assert apd.employee(afm='114749926')['amka'] == '05088202253'
+    assert apd.employee(ama='007811526')['amka'] == '05088202253'
+    assert apd.employee(amka='00000000000') is None
+    records = apd.records_for(amka='05088202253')
+    assert [rec['apodoxes'] for rec in records] == [80.0]
+    assert apd.records_for(afm='999999999') == []
+    with pytest.raises(ValueError):
+        apd.employee(amka='05088202253', afm='114749926')
+
+
+def test_batch_transform():
+    apd = ftf.apd_builder(cents=True)
+    apd.parse(os.path.join(dir_path, 'CSL01'))
+
+    def change_kad(line):
+        line['kad'] = '5541'
+        return line
+
+    apd.transform(change_kad)
+    assert {rec['kad'] for rec in apd.records_for(amka='05088202253')} == {
+        '5541'}
+    apd.DublicateLines()
+    assert len(apd.lines) == 38
+    assert apd.lines[0]['apodoxes'] == 139000
+    assert not apd.errors_found()
+    records = apd.records_for(amka='05088202253')
+    assert [rec['apodoxes_type'] for rec in records] == ['001', 18]
+    assert all(apd.lines[i] is records[n] for n, i in enumerate(
+        apd.ergnoi[apd.employee_index['amka']['05088202253'][0]]))
+    apd.expand(lambda line: [], line_code='2')
+    assert apd.total_ergnoi == 0
+
+
+def test_render_to(tmp_path):
+    bfile = os.path.join(dir_path, 'CSL01')
+    apd = ftf.apd_builder()
+    apd.parse(bfile)
+    stream = io.BytesIO()
+    apd.render_to(stream, newline='\n', chunk_size=100)
+    assert stream.getvalue() == apd.render().encode(ftf.ENCODING) + b'\n'
+    zfile = str(tmp_path / 'out.zip')
+    apd.render2file(zfile)
+    again = ftf.apd_builder()
+    again.parse(zfile)
+    assert again.render() == apd.render()
+
+
+def test_round_trip_passthrough():
+    bfile = os.path.join(dir_path, 'CSL01')
+    with open(bfile, 'rb') as fil:
+        original = fil.read()
+    apd = ftf.apd_builder(keep_raw=True)
+    apd.parse(bfile)
+    assert apd.newline == '\r\n'
+    apd.lines[0]['apodoxes'] = 1.0
+    apd.correct_header()
+    stream = io.BytesIO()
+    apd.render_to(stream)
+    assert stream.getvalue() == original
+    assert apd.lines[0].raw is None
+    assert apd.lines[1].raw == original.split(b'\r\n')[1]
+
+
+def test_shared_schema():
+    bfile = os.path.join(dir_path, 'CSL01')
+    apd = ftf.apd_builder(shared=True)
+    apd.parse(bfile)
+    other = ftf.apd_builder(shared=True)
+    assert other.linetypes['3'] is apd.linetypes['3']
+    assert other.lines == []
+    fresh = ftf.apd_builder()
+    fresh.parse(bfile)
+    assert apd.render() == fresh.render()
+
+
+def test_parse_bytes_and_files():
+    bfile = os.path.join(dir_path, 'CSL01')
+    apd = ftf.apd_builder()
+    apd.parse(bfile)
+    with open(bfile, 'rb') as fil:
+        data = fil.read()
+    zdata = io.BytesIO()
+    with zipfile.ZipFile(zdata, 'w') as zfl:
+        zfl.writestr('CSL01', data)
+    zdata.seek(0)
+    for source in (data, io.BytesIO(data), zdata.getvalue(), zdata):
+        other = ftf.apd_builder()
+        other.parse(source)
+        assert other.render() == apd.render()
+
+
+class OldSpooledFile:
+    """A file object without seekable(), as SpooledTemporaryFile < 3.11"""
+
+    def __init__(self, data):
+        self._file = io.BytesIO(data)
+        self.tell = self._file.tell
+        self.seek = self._file.seek
+        self.read = self._file.read
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+def test_is_zip_without_seekable():
+    zdata = io.BytesIO()
+    with zipfile.ZipFile(zdata, 'w') as zfl:
+        zfl.writestr('CSL01', b'x')
+    fil = OldSpooledFile(zdata.getvalue())
+    assert ftf.is_zip(fil) and fil.tell() == 0
+    assert not ftf.is_zip(OldSpooledFile(b'1x'))
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_direct_edit_updates_totals(columnar):
+    apd = ftf.apd_builder(columnar=columnar)
+    apd.parse(os.path.join(dir_path, 'CSL01'))
+    assert apd.errors_found() == []
+    apd.lines[2]['apodoxes'] = apd.lines[2]['apodoxes'] + 1000.0
+    assert apd.get_totals() == (1695.0, 309.95, 16)
+    assert apd.errors_found()
+    apd.correct_header()
+    assert apd.errors_found() == []
+    assert apd.lines[0]['apodoxes'] == 1695.0
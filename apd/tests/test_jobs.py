@@ -0,0 +1,188 @@
+import io
+import os
+import sys
+import time
+import subprocess
+import pytest
+
+pytest.importorskip('flask')
+from apd.flask import start  # noqa: E402
+from apd.flask import jobs as jobs_module  # noqa: E402
+from apd.flask.jobs import JobQueue  # noqa: E402
+from apd.flask.cache import ResultCache  # noqa: E402
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+def wait(client, url):
+    for _ in range(200):
+        state = client.get(url).get_json()
+        if state['status'] in ('done', 'error'):
+            return state
+        time.sleep(0.05)
+    raise AssertionError('job did not finish')
+
+
+def test_jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(start, 'jobs', JobQueue(str(tmp_path), workers=1))
+    client = start.app.test_client()
+    with open(os.path.join(dir_path, 'CSL01'), 'rb') as fil:
+        resp = client.post('/jobs', data={'file': (fil, 'CSL01')})
+    assert resp.status_code == 202
+    job = resp.get_json()
+    state = wait(client, job['status_url'])
+    assert state['status'] == 'done'
+    assert state['errors_found'] == []
+    resp = client.get(job['download_url'])
+    assert resp.status_code == 200
+    assert resp.data.startswith(b'%PDF')
+    resp.close()
+    # the client's filename never names a file of the job
+    with open(os.path.join(dir_path, 'CSL01'), 'rb') as fil:
+        resp = client.post('/jobs', data={'file': (fil, 'job.json')})
+    assert wait(client, resp.get_json()['status_url'])['status'] == 'done'
+    with open(__file__, 'rb') as fil:
+        resp = client.post('/jobs', data={'file': (fil, 'x')})
+    state = wait(client, resp.get_json()['status_url'])
+    assert state['status'] == 'error'
+    assert client.get(resp.get_json()['download_url']).status_code == 409
+    assert client.get('/jobs/../etc').status_code == 404
+    assert client.get('/jobs/' + '0' * 32).status_code == 404
+
+
+def test_cached_upload(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / 'cache'), max_entries=1)
+    queue = JobQueue(str(tmp_path / 'jobs'), workers=1, cache=cache)
+    monkeypatch.setattr(start, 'jobs', queue)
+    monkeypatch.setattr(start, 'cache', cache)
+    client = start.app.test_client()
+    jobs = []
+    for _ in range(2):
+        with open(os.path.join(dir_path, 'CSL01'), 'rb') as fil:
+            resp = client.post('/jobs', data={'file': (fil, 'CSL01')})
+        jobs.append(resp.get_json())
+        state = wait(client, jobs[-1]['status_url'])
+    assert state['cached'] and state['key'] == queue.status(jobs[0]['id'])['key']
+    resp = client.get(jobs[1]['download_url'])
+    assert resp.headers['ETag'] == f'"{state["key"]}"'
+    resp.close()
+    resp = client.get(f"/pdf/{state['key']}",
+                      headers={'If-None-Match': f'"{state["key"]}"'})
+    assert resp.status_code == 304
+    other = tmp_path / 'other.pdf'
+    other.write_bytes(b'%PDF')
+    cache.put('f' * 64, str(other))
+    assert cache.get(state['key']) is None
+    assert client.get(jobs[1]['download_url']).status_code == 410
+
+
+def test_inline_pdf(tmp_path, monkeypatch):
+    monkeypatch.setattr(start, 'cache', ResultCache(str(tmp_path / 'cache')))
+    monkeypatch.setattr(start, 'jobs', JobQueue(str(tmp_path / 'jobs')))
+    client = start.app.test_client()
+    with open(os.path.join(dir_path, 'CSL01'), 'rb') as fil:
+        data = fil.read()
+    resp = client.post('/getpdf', data={'file': (io.BytesIO(data), 'CSL01')})
+    assert resp.mimetype == 'application/pdf'
+    assert resp.data.startswith(b'%PDF')
+    employee = data.splitlines(keepends=True)[1]
+    for bad in (b'1x\n', b'hello', b'', employee):
+        resp = client.post('/getpdf', data={'file': (io.BytesIO(bad), 'bad')})
+        assert resp.status_code == 400
+
+
+def die(jobdir, cache=None):
+    os._exit(1)
+
+
+def test_dead_worker(tmp_path, monkeypatch):
+    queue = JobQueue(str(tmp_path), workers=1, timeout=60)
+    monkeypatch.setattr(start, 'jobs', queue)
+    monkeypatch.setattr(jobs_module, 'convert', die)
+    client = start.app.test_client()
+    with open(os.path.join(dir_path, 'CSL01'), 'rb') as fil:
+        data = fil.read()
+    resp = client.post('/jobs', data={'file': (io.BytesIO(data), 'CSL01')})
+    state = wait(client, resp.get_json()['status_url'])
+    assert state['status'] == 'error'
+    assert 'BrokenProcessPool' in state['error']
+    monkeypatch.undo()
+    monkeypatch.setattr(start, 'jobs', queue)
+    # the broken pool is replaced
+    resp = client.post('/jobs', data={'file': (io.BytesIO(data), 'CSL01')})
+    assert resp.status_code == 202
+    assert wait(client, resp.get_json()['status_url'])['status'] == 'done'
+    # jobs whose process is gone time out
+    jobdir = queue.jobdir(resp.get_json()['id'])
+    jobs_module.update_state(jobdir, status='running', finished=None,
+                             submitted=time.time() - 120)
+    queue.purge()
+    state = queue.status(resp.get_json()['id'])
+    assert (state['status'], state['error']) == ('error', 'Timed out')
+
+
+def test_inline_cached(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path))
+    monkeypatch.setattr(start, 'cache', cache)
+    client = start.app.test_client()
+    with open(os.path.join(dir_path, 'CSL01'), 'rb') as fil:
+        data = fil.read()
+    resp = client.post('/getpdf', data={'file': (io.BytesIO(data), 'CSL01')})
+    etag = resp.headers['ETag']
+    # stored once the response is sent
+    assert os.listdir(tmp_path) == []
+    resp.close()
+    assert len(os.listdir(tmp_path)) == 1
+    assert cache.get(etag.strip('"')) is not None
+    monkeypatch.setattr(start.apd2pdf, 'run', None)  # not rendered again
+    resp = client.post('/getpdf', data={'file': (io.BytesIO(data), 'CSL01')})
+    assert resp.headers['ETag'] == etag
+    assert resp.data.startswith(b'%PDF')
+    resp.close()
+
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    return proc.pid
+
+
+def test_orphaned_jobs(tmp_path):
+    queue = JobQueue(str(tmp_path), workers=1)
+    queue.draining = True  # queued on disk, claimed by nobody
+    with open(os.path.join(dir_path, 'CSL01'), 'rb') as fil:
+        ids = [queue.submit(io.BytesIO(fil.read()), 'CSL01')]
+    ids.append(queue.submit(io.BytesIO(b'0' * 10), 'CSL01'))
+    assert queue.busy == 0
+    # as left by a worker that was recycled
+    jobs_module.update_state(queue.jobdir(ids[0]), owner=dead_pid())
+    jobs_module.update_state(queue.jobdir(ids[1]), status='running',
+                             owner=dead_pid(),
+                             attempts=jobs_module.MAX_ATTEMPTS - 1)
+    queue.draining = False
+    for _ in range(200):
+        states = [queue.status(job_id, poll=0) for job_id in ids]
+        if all(state['finished'] for state in states):
+            break
+        time.sleep(0.05)
+    assert states[0]['status'] == 'done'
+    assert states[0]['attempts'] == 0
+    assert states[1]['status'] == 'error'
+    assert 'attempts' in states[1]['error']
+
+
+def test_cache_running_size(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path), max_bytes=25, max_entries=3)
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: scans.append(path)
+                        or scandir(path))
+    for key in 'abcd':
+        cache.store(key * 64, b'0123456789')
+    # counted by the first, listed again by the two over max_bytes
+    assert len(scans) == 3
+    assert sorted(os.listdir(tmp_path)) == ['c' * 64 + '.pdf',
+                                            'd' * 64 + '.pdf']
+    cache.store('d' * 64, b'01234')
+    assert len(scans) == 3
+    assert (cache._bytes, cache._count) == (15, 2)
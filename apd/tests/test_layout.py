@@ -0,0 +1,27 @@
+import os
+from apd import apd2pdf, layout
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+bfile = os.path.join(dir_path, 'CSL01')
+
+
+def test_page_map():
+    lay = layout.plan(bfile)
+    assert lay.pages == apd2pdf.build(bfile).page == 8
+    assert lay.report_lines(0, lay.lines) == list(
+        apd2pdf.report_lines(lay.apd.for_report()))
+    assert lay.report_lines(40, 75) == lay.report_lines(0, lay.lines)[40:75]
+    pages = lay.page_map()
+    assert pages[1] == (2, 2)
+    assert lay.employee_page(amka='05088202253') == pages[3][0]
+    assert lay.employee_page(amka='00000000000') is None
+
+
+def test_render_pages():
+    lay = layout.plan(bfile)
+    assert lay.render_pages(1).page == 1
+    pdf = lay.render_pages(2, 3)
+    assert len(pdf.pages) == 2
+    pdf = lay.render_pages(6, 99)
+    assert (len(pdf.pages), pdf.page_offset, pdf.page_total) == (3, 5, 8)
+    assert bytes(pdf.output()).startswith(b'%PDF')
@@ -0,0 +1,71 @@
+import os
+import json
+import pytest
+from apd import metrics
+from apd import apd2pdf
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+@pytest.fixture
+def enabled():
+    metrics.enable()
+    yield metrics
+    metrics.disable()
+
+
+def csl01():
+    with open(os.path.join(dir_path, 'CSL01'), 'rb') as fil:
+        return fil.read()
+
+
+def test_disabled():
+    metrics.disable()
+    assert metrics.stage('parse') is metrics.NO_STAGE
+    blocks = iter([1, 2])
+    assert metrics.timed(blocks, 'parse') is blocks
+    metrics.inc('apd_jobs_total', status='done')
+    assert metrics.collect() == {}
+
+
+def test_stages(enabled):
+    apd2pdf.run(csl01())
+    text = metrics.render()
+    for stage in ('parse', 'layout', 'output'):
+        assert f'apd_stage_seconds_count{{stage="{stage}"}} 1' in text
+    assert 'apd_records_count{kind="payroll"} 1' in text
+    assert 'apd_records_sum{kind="employee"} 12' in text
+    assert 'apd_pdf_pages_bucket{le="+Inf"} 1' in text
+
+
+def test_processes(enabled, tmp_path):
+    metrics.enable(str(tmp_path))
+    metrics.inc('apd_jobs_in_flight')
+    metrics.inc('apd_jobs_total', status='done')
+    # an exited process: its counters stay, its gauges go
+    dead = [['apd_jobs_total', [['status', 'done']], 2],
+            ['apd_jobs_in_flight', [], 5]]
+    (tmp_path / '999999999.json').write_text(json.dumps(dead))
+    for _ in range(2):
+        text = metrics.render()
+        assert 'apd_jobs_total{status="done"} 3' in text
+        assert 'apd_jobs_in_flight 1' in text
+    assert not (tmp_path / '999999999.json').exists()
+    assert (tmp_path / 'dead.json').exists()
+
+
+def test_metrics_endpoint(enabled, tmp_path, monkeypatch):
+    pytest.importorskip('flask')
+    from apd.flask import start
+    from apd.flask.cache import ResultCache
+    monkeypatch.setattr(start, 'cache', ResultCache(str(tmp_path)))
+    client = start.app.test_client()
+    client.post('/api/totals', data=csl01())
+    resp = client.get('/metrics')
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/plain'
+    assert 'apd_stage_seconds_count{stage="scan"} 1' in resp.get_data(True)
+    assert 'apd_request_seconds_count{endpoint="api.totals"} 1' in \
+        resp.get_data(True)
+    metrics.disable()
+    assert client.get('/metrics').status_code == 404
@@ -0,0 +1,50 @@
+import os
+import runpy
+import logging
+import pytest
+
+pytest.importorskip('flask')
+from apd.flask import start  # noqa: E402
+from apd.flask.jobs import JobQueue  # noqa: E402
+from apd.flask.cache import ResultCache  # noqa: E402
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+CONF = os.path.join(dir_path, '..', '..', 'gunicorn.conf.py')
+
+
+class Worker:
+    pid = 1
+    alive = True
+    log = logging.getLogger('gunicorn.test')
+
+
+def test_gunicorn_conf(monkeypatch, tmp_path):
+    queue = JobQueue(str(tmp_path))
+    monkeypatch.setattr(start, 'jobs', queue)
+    monkeypatch.setenv('APD_WEB_WORKERS', '3')
+    monkeypatch.setenv('APD_MAX_WORKER_MB', '100000')
+    monkeypatch.setenv('APD_JOB_WORKERS', '1')
+    conf = runpy.run_path(CONF)
+    assert conf['preload_app'] and conf['workers'] == 3
+    assert conf['bind'].endswith(':8000')
+    worker = Worker()
+    conf['post_request'](worker, None, {}, None)
+    assert worker.alive
+    conf['post_request'].__globals__['max_worker_mb'] = 0
+    conf['post_request'](worker, None, {}, None)
+    assert not worker.alive and queue.draining
+    # not replaced while it has jobs in flight
+    monkeypatch.setattr(JobQueue, 'busy', 1)
+    worker.alive = True
+    conf['post_request'](worker, None, {}, None)
+    assert worker.alive
+
+
+def test_upload_limit(monkeypatch, tmp_path):
+    monkeypatch.setattr(start, 'cache', ResultCache(str(tmp_path / 'cache')))
+    monkeypatch.setattr(start, 'jobs', JobQueue(str(tmp_path / 'jobs')))
+    monkeypatch.setitem(start.app.config, 'MAX_CONTENT_LENGTH', 1000)
+    client = start.app.test_client()
+    with open(os.path.join(dir_path, 'CSL01'), 'rb') as fil:
+        resp = client.post('/getpdf', data={'file': (fil, 'CSL01')})
+    assert resp.status_code == 413
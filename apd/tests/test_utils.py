@@ -34,3 +34,10 @@ def test_is_afm():
     assert not utl.is_afm('094025818')
     assert not utl.is_afm('0')
     assert not utl.is_afm('0940258179')
+
+
+def test_cents2gr():
+    assert utl.cents2gr(0) == ''
+    assert utl.cents2gr(69500) == utl.dec2gr(695.0) == '695,00'
+    assert utl.cents2gr(123456789) == '1.234.567,89'
+    assert utl.cents2gr(-5) == '-0,05'
@@ -130,3 +130,12 @@ def dec2gr(anum):
     if anum == 0:
         return ''
     return f'{anum:,.2f}'.replace(',', '|').replace('.', ',').replace('|', '.')
+
+
+def cents2gr(cents):
+    """Integer cents to greek formatted number, same output as dec2gr"""
+    if cents == 0:
+        return ''
+    sign = '-' if cents < 0 else ''
+    units, cents = divmod(abs(cents), 100)
+    return f'{sign}{units:,}'.replace(',', '.') + f',{cents:02}'
@@ -0,0 +1,90 @@
+"""gunicorn settings for wsgi:app
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is imported once in the master (preload), which loads the fonts
+and the compiled schema (apd2pdf.warm_up), then the heap is frozen so
+the forked workers share those pages instead of copying them.
+
+Workers are replaced after max_requests requests or past max_worker_mb,
+but not while they have background conversions in flight: a worker due
+for replacement stops claiming jobs (JobQueue.draining) and is replaced
+after its first request once they have finished. The conversions run
+in forkserver pool processes, not forks of the worker; jobs a worker
+leaves behind anyway (killed, graceful_timeout) are put back in the
+queue by the other workers (see apd.flask.jobs).
+
+Environment (defaults in brackets):
+    APD_PORT             listening port [8000]
+    APD_WEB_WORKERS      worker processes [number of CPUs]
+    APD_WEB_THREADS      threads per worker [4]
+    APD_MAX_REQUESTS     requests before a worker is replaced [1000]
+    APD_MAX_WORKER_MB    peak RSS (MB) after which a worker is replaced [512]
+    APD_TIMEOUT          seconds a request may take [120]
+    APD_METRICS          1 serves /metrics [off]
+    APD_METRICS_DIR      where the processes keep their metrics [a new
+                         temporary directory per server start]
+"""
+import os
+import gc
+import resource
+import tempfile
+
+cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+    else os.cpu_count() or 1
+
+bind = f"0.0.0.0:{os.environ.get('APD_PORT', '8000')}"
+preload_app = True
+
+# PDF rendering is CPU bound: a process per CPU; the threads overlap
+# uploads, downloads and the waits of the job status polls
+workers = int(os.environ.get('APD_WEB_WORKERS', cpus))
+threads = int(os.environ.get('APD_WEB_THREADS', 4))
+worker_class = 'gthread'
+# the background conversions get the CPUs the web workers leave
+os.environ.setdefault('APD_JOB_WORKERS', str(max(1, cpus // workers)))
+
+# every worker and conversion process reports to /metrics through files
+if os.environ.get('APD_METRICS', '') not in ('', '0'):
+    os.environ.setdefault('APD_METRICS_DIR',
+                          tempfile.mkdtemp(prefix='apd-metrics-'))
+
+max_requests = int(os.environ.get('APD_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+max_worker_mb = int(os.environ.get('APD_MAX_WORKER_MB', 512))
+
+timeout = int(os.environ.get('APD_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+# heartbeat files in memory, not on the (overlay) disk of a container
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# request line and headers; the body limit is MAX_CONTENT_LENGTH of the app
+limit_request_line = 4094
+limit_request_fields = 100
+limit_request_field_size = 8190
+
+
+def when_ready(server):
+    # everything loaded by the preloaded app stays shared after fork
+    gc.collect()
+    gc.freeze()
+
+
+def post_request(worker, req, environ, resp):
+    """Replace the worker once its peak memory is over max_worker_mb
+
+    Replacement (for memory or max_requests) waits for the jobs the
+    worker has in flight.
+    """
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if peak_mb > max_worker_mb:
+        worker.log.info('Worker %s at %d MB, replacing it', worker.pid, peak_mb)
+        worker.alive = False
+    if not worker.alive:
+        from apd.flask.start import jobs
+        jobs.draining = True
+        if jobs.busy:
+            worker.log.info('Worker %s has %d jobs, replacing it later',
+                            worker.pid, jobs.busy)
+            worker.alive = True
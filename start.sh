@@ -1,2 +1,2 @@
 #!/bin/sh
-gunicorn --bind 0.0.0.0:8001 wsgi:app
+exec gunicorn -c gunicorn.conf.py wsgi:app